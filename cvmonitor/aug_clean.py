@@ -1,26 +1,274 @@
+import bisect
+import logging
+import math
 import numpy as np
 import re
-import datetime
+import sys
+import time
 
+# Characters an ocr reading may contain, the rest are removed
+INVALID_CHARS = re.compile('[^0-9.:/]+')
+# Drop the separators of a temperature
+TEMP_SEPARATORS = str.maketrans('', '', ':/')
+# A frame without a timestamp whose imageId is at most this much below the last one is out of order,
+# a larger jump back is taken as the client restarting its count
+MAX_REORDER = 64
 
-class SensorValue:
 
-    def __init__(self, name):
-        self.sensor_name = name
-        self.last_valid_time = datetime.datetime(1970, 1, 1)
-        self.last_valid_value = None
+def parse_image_id(imageId):
+    """
+    The imageId as an int, None if it is not a number
+    """
+    try:
+        return int(imageId)
+    except (TypeError, ValueError):
+        return None
+
+
+class SensorStore:
+    """
+    The last valid value and time of every sensor of many monitors, in arrays indexed by (monitor slot, sensor).
+    Times are time.monotonic() seconds. A monitor gets a slot with allocate() and gives it back with release(),
+    the arrays grow by whole slots (and sensors) when needed.
+    """
+
+    def __init__(self, sensors, slots=64):
+        self.sensor_index = {name: i for i, name in enumerate(sensors)}
+        self.times = np.full((slots, len(self.sensor_index)), -np.inf)
+        self.values = np.full((slots, len(self.sensor_index)), None, dtype=object)
+        self.free = list(range(slots - 1, -1, -1))
+
+    def allocate(self):
+        if not self.free:
+            slots = len(self.times)
+            self.grow(slots * 2, self.times.shape[1])
+            self.free = list(range(slots * 2 - 1, slots - 1, -1))
+        return self.free.pop()
+
+    def release(self, slot):
+        self.times[slot] = -np.inf
+        self.values[slot] = None
+        self.free.append(slot)
+
+    def sensor(self, name):
+        """
+        The index of a sensor, adding it if it is unknown
+        """
+        index = self.sensor_index.get(name)
+        if index is None:
+            index = self.sensor_index[name] = len(self.sensor_index)
+            self.grow(len(self.times), index + 1)
+        return index
+
+    def grow(self, slots, sensors):
+        times = np.full((slots, sensors), -np.inf)
+        values = np.full((slots, sensors), None, dtype=object)
+        times[:self.times.shape[0], :self.times.shape[1]] = self.times
+        values[:self.values.shape[0], :self.values.shape[1]] = self.values
+        self.times, self.values = times, values
+
+    def slot_nbytes(self, slot):
+        """
+        Approximate memory held by the values of one monitor
+        """
+        row = self.values[slot]
+        return self.times[slot].nbytes + row.nbytes + sum(sys.getsizeof(v) for v in row if v is not None)
+
+    def nbytes(self):
+        return self.times.nbytes + self.values.nbytes + sum(sys.getsizeof(v) for v in self.values.flat if v is not None)
+
+
+class SensorHistory:
+    """
+    The last `size` valid readings of one sensor, in ring buffers, with wall clock times.
+    The mode, median, min and max of the window are kept up to date as readings come in and drop out,
+    so reading them never scans the window: the readings are counted (and grouped by count, for the mode)
+    and the numeric ones are kept sorted (for the median, min and max). Reading them is O(1), adding a reading is
+    O(size) for the insert into and delete from the sorted list (a memmove of at most size pointers).
+    """
+    __slots__ = ('times', 'values', 'numbers', 'head', 'count', 'ordered', 'counts', 'by_count', 'top')
+
+    def __init__(self, size=32):
+        self.times = np.zeros(size)
+        self.values = np.full(size, None, dtype=object)
+        self.numbers = np.full(size, np.nan)
+        # index of the next reading, the oldest one once the window is full
+        self.head = 0
+        self.count = 0
+        # the numeric readings of the window, sorted
+        self.ordered = []
+        # reading -> number of times it is in the window
+        self.counts = {}
+        # number of times -> readings (a dict as an ordered set, the last one got that count last)
+        self.by_count = {}
+        self.top = 0
+
+    def __len__(self):
+        return self.count
+
+    def add(self, t, value):
+        if self.count == len(self.values):
+            self.drop(self.head)
+        else:
+            self.count += 1
+        try:
+            number = float(value)
+        except (TypeError, ValueError):
+            number = math.nan
+        self.times[self.head] = t
+        self.values[self.head] = value
+        self.numbers[self.head] = number
+        self.count_value(value, 1)
+        if not math.isnan(number):
+            bisect.insort(self.ordered, number)
+        self.head = (self.head + 1) % len(self.values)
+
+    def drop(self, index):
+        self.count_value(self.values[index], -1)
+        number = self.numbers[index]
+        if not math.isnan(number):
+            del self.ordered[bisect.bisect_left(self.ordered, number)]
+
+    def count_value(self, value, delta):
+        count = self.counts.pop(value, 0)
+        if count:
+            readings = self.by_count[count]
+            del readings[value]
+            if not readings:
+                del self.by_count[count]
+                if count == self.top and delta < 0:
+                    self.top -= 1
+        count += delta
+        if count:
+            self.counts[value] = count
+            self.by_count.setdefault(count, {})[value] = None
+            self.top = max(self.top, count)
+
+    def mode(self):
+        """
+        The most common reading, the one that got there last on ties
+        """
+        return next(reversed(self.by_count[self.top])) if self.top else None
+
+    def median(self):
+        n = len(self.ordered)
+        if not n:
+            return None
+        if n % 2:
+            return self.ordered[n // 2]
+        return (self.ordered[n // 2 - 1] + self.ordered[n // 2]) / 2
+
+    def min(self):
+        return self.ordered[0] if self.ordered else None
+
+    def max(self):
+        return self.ordered[-1] if self.ordered else None
+
+    def series(self, limit=None):
+        """
+        The times and readings of the window (the last `limit` of them), oldest first
+        """
+        count = self.count if limit is None else min(limit, self.count)
+        index = (self.head - count + np.arange(count)) % len(self.values)
+        return self.times[index], self.values[index]
+
+    def nbytes(self):
+        return (
+            self.times.nbytes + self.values.nbytes + self.numbers.nbytes + sys.getsizeof(self.ordered)
+            + sys.getsizeof(self.counts) + sys.getsizeof(self.by_count) + sum(sys.getsizeof(v) for v in self.by_count.values())
+        )
 
 
 class MonitorValues:
     """
     Clean *numeric* monitor values.
+    The last valid values are kept in a slot of `store`, shared by many monitors (or of its own store if not given).
+    :param overlaps: counter (with a sensor label) of values dropped since another sensor had the same value
+    :param history_size: number of valid readings of each sensor kept in its SensorHistory (0 to keep none)
     """
+    __slots__ = ('sensors', 'store', 'slot', 'value_sensors', 'overlaps', 'history_size', 'histories', 'last_image', 'last_time')
 
-    def __init__(self, sensors):
+    def __init__(self, sensors, store=None, overlaps=None, history_size=0):
         self.sensors = sensors
-        self.values_dict = {name: SensorValue(name) for name in sensors.keys()}
+        self.store = store if store is not None else SensorStore(sensors, slots=1)
+        self.slot = self.store.allocate()
+        # last valid value (as a string) -> names of the sensors that have it
+        self.value_sensors = {}
+        self.overlaps = overlaps
+        self.history_size = history_size
+        # sensor name -> SensorHistory
+        self.histories = {}
+        # the imageId and capture time of the newest frame
+        self.last_image = None
+        self.last_time = None
+
+    def release(self):
+        """
+        Give the slot back to the store, the monitor values should not be used anymore
+        """
+        self.store.release(self.slot)
+        self.value_sensors.clear()
+        self.histories.clear()
 
-    def get_latest_valid_value(self, augs_dict, window_size=10):
+    def is_late(self, imageId, t=None):
+        """
+        Whether a frame is older than the newest frame seen, by capture time if both have one, otherwise by imageId.
+        A monitor whose clients send a timestamp with some frames and not with others is ordered by imageId between
+        those, so a client should either always send it or never.
+        :param t: the capture time of the frame (time.monotonic() seconds), if it has one
+        """
+        imageId = parse_image_id(imageId)
+        if t is not None and self.last_time is not None:
+            return t < self.last_time
+        return imageId is not None and self.last_image is not None and 0 < self.last_image - imageId <= MAX_REORDER
+
+    def set_newest(self, imageId, t=None):
+        """
+        Make a frame that is not late (see is_late) the newest one
+        """
+        imageId = parse_image_id(imageId)
+        if imageId is not None:
+            self.last_image = imageId
+        if t is not None:
+            self.last_time = t
+
+    def record(self, name, value, t):
+        """
+        Add a valid reading (at time.monotonic() seconds t) to the history of a sensor
+        """
+        if not self.history_size:
+            return
+        history = self.histories.get(name)
+        if history is None:
+            history = self.histories[name] = SensorHistory(self.history_size)
+        history.add(t, value)
+
+    def history_nbytes(self):
+        return sum(history.nbytes() for history in self.histories.values())
+
+    def last_valid_value(self, name):
+        index = self.store.sensor_index.get(name)
+        return None if index is None else self.store.values[self.slot, index]
+
+    def set_last_valid_value(self, name, index, value):
+        previous = self.store.values[self.slot, index]
+        if previous is not None:
+            sensors = self.value_sensors[str(previous)]
+            sensors.discard(name)
+            if not sensors:
+                del self.value_sensors[str(previous)]
+        self.store.values[self.slot, index] = value
+        self.value_sensors.setdefault(str(value), set()).add(name)
+
+    def nbytes(self):
+        """
+        Approximate memory held by the monitor values
+        """
+        return sys.getsizeof(self) + self.store.slot_nbytes(self.slot) + sys.getsizeof(self.value_sensors) + sum(
+            sys.getsizeof(sensors) for sensors in self.value_sensors.values()
+        ) + self.history_nbytes()
+
+    def get_latest_valid_value(self, augs_dict, window_size=10, now=None):
         """
         Returns a single valid value from the OCR readings. If fails to clean the current readings, take the last valid reading
         within the stated time frame, or None if there isn't one.
@@ -30,22 +278,23 @@ class MonitorValues:
                          value: [37, 37.2]
                         },
             window_size: 10 (seconds)
+            now: the time of the readings in time.monotonic() seconds, e.g. their capture time (default: now)
         Returns:
             value: 37.2
         """
+        if now is None:
+            now = time.monotonic()
         value = self.get_value_from_augs(augs_dict)
-        sensor_name = augs_dict["name"]
-
         # TODO Do we want to throw an exception in that case? This requires defining all possible sensors beforehand
-        if sensor_name not in self.values_dict:
-            self.values_dict[sensor_name] = SensorValue(sensor_name)
+        index = self.store.sensor(augs_dict["name"])
 
         if value is None:
-            if datetime.datetime.now() - self.values_dict[sensor_name].last_valid_time <= datetime.timedelta(0, window_size):
-                value = self.values_dict[sensor_name].last_valid_value
+            if now - self.store.times[self.slot, index] <= window_size:
+                value = self.store.values[self.slot, index]
         else:
-            self.values_dict[sensor_name].last_valid_time = datetime.datetime.now()
-            self.values_dict[sensor_name].last_valid_value = value
+            self.store.times[self.slot, index] = now
+            self.set_last_valid_value(augs_dict["name"], index, value)
+            self.record(augs_dict["name"], value, now)
 
         return value
 
@@ -72,17 +321,14 @@ class MonitorValues:
             return augs_dict["clean_value"][0]
 
     def remove_sensor_overlap(self, values, name):
-        global overlaps
         result = set()
-        vl = list(values)
-        for i, cur_v in enumerate(vl):
-            found_overlap = False
-            for sensor_name, sensor_value in self.values_dict.items():
-                if sensor_name != name and str(sensor_value.last_valid_value) == cur_v:
-                    print("found overlap in {}:{} with previous {}:{}".format(name, cur_v, sensor_name, sensor_value.last_valid_value))
-                    found_overlap = True
-                    overlaps += 1
-            if not found_overlap:
+        for cur_v in values:
+            sensors = self.value_sensors.get(cur_v, ())
+            if len(sensors) > (name in sensors):
+                logging.debug(f"found overlap in {name}:{cur_v} with previous {sorted(sensors - {name})}")
+                if self.overlaps is not None:
+                    self.overlaps.labels(name).inc()
+            else:
                 result.add(cur_v)
         return result
 
@@ -92,8 +338,8 @@ class MonitorValues:
             clean_dict = {'name': name, 'clean_value': [v]}
             if is_valid_ranges(clean_dict, self.sensors):
                 result.add(v)
-            elif name in self.values_dict and v in str(self.values_dict[name].last_valid_value):
-                result.add(str(self.values_dict[name].last_valid_value))
+            elif name in self.store.sensor_index and v in str(self.last_valid_value(name)):
+                result.add(str(self.last_valid_value(name)))
         return result
 
     def get_clean_value(self, augs_dict):
@@ -110,7 +356,7 @@ class MonitorValues:
 
         values = augs_dict["value"]
         # remove invalid characters
-        result = list(filter(lambda x: x != '', set([re.sub('[^0-9.:/]', '', v) for v in values])))
+        result = list(filter(lambda x: x != '', set([INVALID_CHARS.sub('', v) for v in values])))
         # fix common temperature error ([372] => [37.2])
         if augs_dict["name"] == "Temp":
             result = fix_temp(result)
@@ -136,7 +382,7 @@ class MonitorValues:
 
 def fix_temp(result):
     for idx, v in enumerate(result):
-        v = re.sub('[:/]', '', v)
+        v = v.translate(TEMP_SEPARATORS)
         if "." not in v and int(v) > 350 and int(v) < 420:
             v = v[:2] + "." + v[-1]
         result[idx] = v
@@ -0,0 +1,266 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Micro benchmarks for the request hot paths, run with:
+    python -m cvmonitor.benchmark <name>
+"""
+import argparse
+import io
+import multiprocessing
+import os
+import re
+import resource
+import timeit
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+
+from .utils import is_int
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), 'test', 'data')
+
+
+def report(name, number, seconds):
+    print(f'{name:>30}: {seconds / number * 1e6:10.1f} us/call')
+
+
+def bench_exif(args):
+    """
+    Per request cost of reading the exif orientation: exifread vs the header-only reader
+    """
+    from .image_align import read_exif_orientation, read_exifread_orientation
+    data = open(args.image or os.path.join(DATA_DIR, 'sample.jpeg'), 'rb').read()
+    assert read_exif_orientation(memoryview(data)) == read_exifread_orientation(io.BytesIO(data))
+    report('exifread', args.number, timeit.timeit(lambda: read_exifread_orientation(io.BytesIO(data)), number=args.number))
+    report('header only', args.number, timeit.timeit(lambda: read_exif_orientation(memoryview(data)), number=args.number))
+
+
+def bench_decode(args):
+    """
+    Per frame cost of decoding a frame for the qr and barcode search: RGB then converted to grayscale vs only the
+    luminance, and the size of the decoded images
+    """
+    from .utils import decode_gray
+    import imageio.v2 as imageio
+    import cv2
+    import numpy as np
+    data = open(args.image or os.path.join(DATA_DIR, 'barcode_monitor.jpg'), 'rb').read()
+
+    def decode_rgb():
+        return cv2.cvtColor(np.asarray(imageio.imread(data)), cv2.COLOR_RGB2GRAY)
+
+    report('rgb + cvtColor', args.number, timeit.timeit(decode_rgb, number=args.number))
+    report('luminance', args.number, timeit.timeit(lambda: decode_gray(data), number=args.number))
+    rgb = np.asarray(imageio.imread(data))
+    print(f'{"rgb + cvtColor":>30}: {(rgb.nbytes + rgb.nbytes // 3) / 1024:10.1f} KB decoded')
+    print(f'{"luminance":>30}: {decode_gray(data).nbytes / 1024:10.1f} KB decoded')
+
+
+def legacy_cleanup_field(field_info, field_value):  # noqa: C901
+    """
+    cleanup_field as it was before the cleaners were compiled, the baseline of bench_clean.
+    A frozen copy of the old code, kept as is (complexity included) so the benchmark measures what it replaced.
+    """
+    res = ''
+    if field_info.get('regex'):
+        regex_res = re.match(field_info.get('regex'), field_value or '')
+        if not regex_res:
+            return ''
+        if field_info.get('sub'):
+            return re.sub(field_info.get('regex'), field_info.get('sub'), field_value or '')
+        return ''.join(regex_res.groups())
+    if field_info.get('dtype') == str:
+        res = field_value
+    if field_info.get('dtype') == int:
+        for c in field_value:
+            if is_int(c):
+                res += c
+                if len(res) >= field_info.get('max_len', 10):
+                    break
+    if field_info.get('dtype') == float:
+        for c in field_value:
+            if is_int(c) or c == '.':
+                res += c
+                if len(res) >= field_info.get('max_len', 10)+1:
+                    break
+    return res
+
+
+def bench_clean(args):
+    """
+    Per segment cost of cleaning an ocr value: the legacy per call regex/is_int cleanup vs the compiled cleaners
+    """
+    from .device_fields import compile_field_cleaner, get_fields_info
+    fields = get_fields_info()
+    values = [' 52', '(15)', '93a', '115 /45', '37.2', 'l2O', '120/8O', 'Vent']
+    segments = [(name, value) for name in fields for value in values]
+    cleaners = {name: compile_field_cleaner(info) for name, info in fields.items()}
+    for name, value in segments:
+        assert cleaners[name](value) == legacy_cleanup_field(fields[name], value)
+
+    def legacy():
+        for name, value in segments:
+            legacy_cleanup_field(fields[name], value)
+
+    def compiled():
+        for name, value in segments:
+            cleaners[name](value)
+    number = args.number * len(segments)
+    report('legacy', number, timeit.timeit(legacy, number=args.number))
+    report('compiled', number, timeit.timeit(compiled, number=args.number))
+
+
+def bench_shard(args):
+    """
+    Throughput of cleaning batches of frames of many monitors: one Cleaner vs 1..cpu_count cleaner shards
+    """
+    from prometheus_client import CollectorRegistry
+    from .device_fields import Cleaner, get_fields_info
+    from .shard import ShardedCleaner
+    names = list(get_fields_info())
+    batch = [(f'monitor-{m}', 1, [{'name': name, 'value': str(60 + m % 40)} for name in names], None) for m in range(256)]
+    number = max(args.number // 100, 1)
+    cleaner = Cleaner(get_fields_info(), registry=CollectorRegistry())
+    report('cleaner', number * len(batch), timeit.timeit(lambda: cleaner.clean_batch(batch), number=number))
+    for shards in range(1, (os.cpu_count() or 1) + 1):
+        cleaner = ShardedCleaner(shards, registry=CollectorRegistry())
+        try:
+            cleaner.clean_batch(batch)
+            report(f'{shards} shards', number * len(batch), timeit.timeit(lambda: cleaner.clean_batch(batch), number=number))
+        finally:
+            cleaner.close()
+
+
+def legacy_encode(image):
+    """
+    Encoding a response image as it was before utils.encode_image, the baseline of bench_encode
+    """
+    import imageio
+    b = io.BytesIO()
+    imageio.imwrite(b, image, format='jpeg')
+    b.seek(0)
+    return b.read()
+
+
+def encode_body(image):
+    from .utils import encode_image
+    return memoryview(encode_image(image)).cast('B')
+
+
+ENCODERS = {'imageio': legacy_encode, 'encode_image': encode_body}
+
+
+def encode_peak_rss(name, path, number):
+    """
+    In a fresh process: the growth of the peak RSS (KB) while encoding `number` frames
+    """
+    import imageio.v2 as imageio
+    import numpy as np
+    image = np.asarray(imageio.imread(path))
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    for _ in range(number):
+        ENCODERS[name](image)
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before
+
+
+def bench_encode(args):
+    """
+    Per request cost of encoding a jpeg response: imageio into a BytesIO and read() vs encode_image sent as a memoryview,
+    the time, the peak of the memory allocated while encoding (the output and its copies) and the peak RSS growth
+    """
+    import imageio.v2 as imageio
+    import numpy as np
+    path = args.image or os.path.join(DATA_DIR, 'sample.jpeg')
+    image = np.asarray(imageio.imread(path))
+    for name, encode in ENCODERS.items():
+        report(name, args.number, timeit.timeit(lambda: encode(image), number=args.number))
+        tracemalloc.start()
+        size = len(encode(image))
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context('spawn')) as pool:
+            rss = pool.submit(encode_peak_rss, name, path, args.number).result()
+        print(f'{name:>30}: {size / 1024:10.1f} KB jpeg, {peak / 1024:10.1f} KB allocated, {rss:8d} KB peak RSS growth')
+
+
+def bench_orient(args):
+    """
+    Per frame cost of aligning a frame that is upside down: rotating the pixels and then warping the rotated copy
+    vs one warp by the homography composed with the rotation
+    """
+    from .image_align import get_rotation_matrix, get_smoothed_homography, rotate_image
+    from .qr import find_qrcode
+    import imageio.v2 as imageio
+    import cv2
+    import numpy as np
+    data = open(args.image or os.path.join(DATA_DIR, 'barcode_monitor.jpg'), 'rb').read()
+    image = cv2.rotate(np.asarray(imageio.imread(data)), cv2.ROTATE_180)
+    detected_qrcode = find_qrcode(image, args.qrprefix)
+    homography, _ = get_smoothed_homography(image.shape, detected_qrcode, rotation=180)
+    M, size = np.asarray(homography['M']), homography['size']
+    # the homography of the rotated copy
+    M_rotated = M @ np.linalg.inv(get_rotation_matrix(180, *image.shape[:2])[0])
+    report('rotate + warp', args.number, timeit.timeit(
+        lambda: cv2.warpPerspective(rotate_image(image, 180), M_rotated, size), number=args.number
+    ))
+    report('composed warp', args.number, timeit.timeit(lambda: cv2.warpPerspective(image, M, size), number=args.number))
+
+
+def bench_segments(args):
+    """
+    Per frame cost of aligning a frame by its qr code: the whole aligned image (align_frame) vs only the tiles of
+    16 segments (align_segments), the warp alone and the whole call, and the size of the output
+    """
+    from .image_align import align_frame, align_segments, warp_segment
+    data = open(args.image or os.path.join(DATA_DIR, 'barcode_monitor.jpg'), 'rb').read()
+    options = dict(use_exif=False, use_qr=True, qrprefix=args.qrprefix)
+    aligned = align_frame(data, align=True, **options)
+    homography = aligned['qr']['homography']
+    width, height = homography['size']
+    # a 4x4 grid of 80x40 segments on the aligned image
+    segments = [
+        {'name': f'{i}', 'left': x, 'top': y, 'right': x + 80, 'bottom': y + 40}
+        for i, (x, y) in enumerate((int(width * (c + 0.5) / 4) - 40, int(height * (r + 0.5) / 4) - 20) for r in range(4) for c in range(4))
+    ]
+    tiles = align_segments(data, segments, qr_hint=aligned['qr'], **options)
+    print(f'canvas {width}x{height}, {len(segments)} segments of 80x40')
+
+    import imageio.v2 as imageio
+    import cv2
+    import numpy as np
+    image = np.asarray(imageio.imread(data))
+    M = np.asarray(homography['M'])
+    report('warp image', args.number, timeit.timeit(lambda: cv2.warpPerspective(image, M, (width, height)), number=args.number))
+    report('warp segments', args.number, timeit.timeit(
+        lambda: [warp_segment(image, M, (s['left'], s['top'], s['right'], s['bottom'])) for s in segments], number=args.number
+    ))
+    report('align_frame', args.number, timeit.timeit(lambda: align_frame(data, align=True, qr_hint=aligned['qr'], **options), number=args.number))
+    report('align_segments', args.number, timeit.timeit(
+        lambda: align_segments(data, segments, qr_hint=aligned['qr'], **options), number=args.number
+    ))
+    print(f'{"align_frame":>30}: {len(aligned["image"]) / 1024:10.1f} KB')
+    print(f'{"align_segments":>30}: {sum(len(tile) for tile in tiles["tiles"]) / 1024:10.1f} KB')
+
+
+BENCHMARKS = {
+    'clean': bench_clean,
+    'decode': bench_decode,
+    'encode': bench_encode,
+    'exif': bench_exif,
+    'orient': bench_orient,
+    'segments': bench_segments,
+    'shard': bench_shard,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('name', choices=sorted(BENCHMARKS.keys()))
+    parser.add_argument('--number', type=int, default=1000, help='number of calls to time')
+    parser.add_argument('--image', help='image to use instead of the test data')
+    parser.add_argument('--qrprefix', default='http', help='prefix of the qr code of the image, for the orient and segments benchmarks')
+    args = parser.parse_args()
+    BENCHMARKS[args.name](args)
+
+
+if __name__ == '__main__':
+    main()
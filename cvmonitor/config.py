@@ -0,0 +1,129 @@
+import os
+from typing import NamedTuple
+
+LOG_LEVELS = ('DEBUG', 'INFO', 'WARNING', 'ERROR')
+
+
+def parse_bool(environ, name, default):
+    value = environ.get(name, default).upper()
+    if value not in ('TRUE', 'FALSE'):
+        raise ValueError(f'{name} should be TRUE or FALSE, got {value}')
+    return value == 'TRUE'
+
+
+def parse_number(environ, name, default, dtype=int, minimum=0):
+    try:
+        value = dtype(environ.get(name, default))
+    except ValueError:
+        raise ValueError(f'{name} should be a number, got {environ.get(name)}')
+    if value < minimum:
+        raise ValueError(f'{name} should be at least {minimum}, got {value}')
+    return value
+
+
+class Settings(NamedTuple):
+    """
+    Server configuration, parsed once from the CVMONITOR_* environment variables.
+    """
+    log_level: str = 'DEBUG'
+    host: str = '0.0.0.0'
+    port: int = 8088
+    orient_by_exif: bool = True
+    orient_by_qr: bool = False
+    qr_prefix: str = 'cvmonitor'
+    qr_target_size: int = 100
+    qr_boundery_size: float = 50.0
+    qr_search_scale: int = 1
+    align_by_qr: bool = False
+    save_before_align: bool = False
+    save_after_align: bool = False
+    align_max_frames: int = 64
+    align_max_segments: int = 64
+    align_max_segment_pixels: int = 4194304
+    qr_cache_size: int = 1024
+    qr_cache_ttl: float = 60.0
+    align_tolerance: float = 1.0
+    align_smoothing: float = 0.5
+    remap_cache_size: int = 16
+    jpeg_quality: int = 75
+    result_log_queue_size: int = 1024
+    monitor_state_size: int = 1024
+    monitor_state_ttl: float = 86400.0
+    state_snapshot: str = ''
+    state_snapshot_interval: float = 10.0
+    cleaner_shards: int = 0
+    history_size: int = 0
+    qr_pdf_rows: int = 6
+    qr_pdf_cols: int = 4
+    workers: int = os.cpu_count()
+    worker_queue_size: int = 64
+
+    @classmethod
+    def from_env(cls, environ=os.environ):
+        """
+        Parse and validate the settings, raises ValueError on bad values
+        """
+        log_level = environ.get('CVMONITOR_LOG_LEVEL', 'DEBUG').upper()
+        if log_level not in LOG_LEVELS:
+            raise ValueError(f'CVMONITOR_LOG_LEVEL should be one of {LOG_LEVELS}, got {log_level}')
+        qr_search_scale = parse_number(environ, 'CVMONITOR_QR_SEARCH_SCALE', '1', minimum=1)
+        if qr_search_scale not in (1, 2, 4, 8):
+            raise ValueError(f'CVMONITOR_QR_SEARCH_SCALE should be 1, 2, 4 or 8, got {qr_search_scale}')
+        jpeg_quality = parse_number(environ, 'CVMONITOR_JPEG_QUALITY', '75', minimum=1)
+        if jpeg_quality > 100:
+            raise ValueError(f'CVMONITOR_JPEG_QUALITY should be at most 100, got {jpeg_quality}')
+        align_smoothing = parse_number(environ, 'CVMONITOR_ALIGN_SMOOTHING', '0.5', float)
+        if not 0 < align_smoothing <= 1:
+            raise ValueError(f'CVMONITOR_ALIGN_SMOOTHING should be in (0, 1], got {align_smoothing}')
+        return cls(
+            log_level=log_level,
+            host=environ.get('CVMONITOR_HOST', '0.0.0.0'),
+            port=parse_number(environ, 'CVMONITOR_PORT', '8088'),
+            orient_by_exif=parse_bool(environ, 'CVMONITOR_ORIENT_BY_EXIF', 'TRUE'),
+            orient_by_qr=parse_bool(environ, 'CVMONITOR_ORIENT_BY_QR', 'FALSE'),
+            qr_prefix=environ.get('CVMONITOR_QR_PREFIX', 'cvmonitor'),
+            qr_target_size=parse_number(environ, 'CVMONITOR_QR_TARGET_SIZE', '100', minimum=1),
+            qr_boundery_size=parse_number(environ, 'CVMONITOR_QR_BOUNDERY_SIZE', '50', float),
+            qr_search_scale=qr_search_scale,
+            align_by_qr=not parse_bool(environ, 'CVMONITOR_SKIP_ALIGN', 'TRUE'),
+            save_before_align=parse_bool(environ, 'CVMONITOR_SAVE_BEFORE_ALIGN', 'FALSE'),
+            save_after_align=parse_bool(environ, 'CVMONITOR_SAVE_AFTER_ALIGN', 'FALSE'),
+            align_max_frames=parse_number(environ, 'CVMONITOR_ALIGN_MAX_FRAMES', '64', minimum=1),
+            align_max_segments=parse_number(environ, 'CVMONITOR_ALIGN_MAX_SEGMENTS', '64', minimum=1),
+            align_max_segment_pixels=parse_number(environ, 'CVMONITOR_ALIGN_MAX_SEGMENT_PIXELS', '4194304', minimum=1),
+            qr_cache_size=parse_number(environ, 'CVMONITOR_QR_CACHE_SIZE', '1024'),
+            qr_cache_ttl=parse_number(environ, 'CVMONITOR_QR_CACHE_TTL', '60', float),
+            align_tolerance=parse_number(environ, 'CVMONITOR_ALIGN_TOLERANCE', '1', float),
+            align_smoothing=align_smoothing,
+            remap_cache_size=parse_number(environ, 'CVMONITOR_REMAP_CACHE_SIZE', '16'),
+            jpeg_quality=jpeg_quality,
+            result_log_queue_size=parse_number(environ, 'CVMONITOR_RESULT_LOG_QUEUE_SIZE', '1024', minimum=1),
+            monitor_state_size=parse_number(environ, 'CVMONITOR_MONITOR_STATE_SIZE', '1024', minimum=1),
+            monitor_state_ttl=parse_number(environ, 'CVMONITOR_MONITOR_STATE_TTL', '86400', float),
+            state_snapshot=environ.get('CVMONITOR_STATE_SNAPSHOT', ''),
+            state_snapshot_interval=parse_number(environ, 'CVMONITOR_STATE_SNAPSHOT_INTERVAL', '10', float, minimum=0.1),
+            cleaner_shards=parse_number(environ, 'CVMONITOR_CLEANER_SHARDS', '0'),
+            history_size=parse_number(environ, 'CVMONITOR_HISTORY_SIZE', '0'),
+            qr_pdf_rows=parse_number(environ, 'CVMONITOR_QR_PDF_ROWS', '6', minimum=1),
+            qr_pdf_cols=parse_number(environ, 'CVMONITOR_QR_PDF_COLS', '4', minimum=1),
+            workers=parse_number(environ, 'CVMONITOR_WORKERS', str(os.cpu_count())),
+            worker_queue_size=parse_number(environ, 'CVMONITOR_WORKER_QUEUE_SIZE', '64'),
+        )
+
+    def align_options(self):
+        """
+        Keyword arguments for image_align.align_frame
+        """
+        return dict(
+            use_exif=self.orient_by_exif,
+            use_qr=self.orient_by_qr,
+            qrprefix=self.qr_prefix,
+            qrsize=self.qr_target_size,
+            boundery=self.qr_boundery_size,
+            align=self.align_by_qr,
+            search_scale=self.qr_search_scale,
+            align_tolerance=self.align_tolerance,
+            align_smoothing=self.align_smoothing,
+            remap_cache_size=self.remap_cache_size,
+            quality=self.jpeg_quality,
+        )
@@ -1,7 +1,14 @@
 import pytest
 
+
 @pytest.fixture(scope='session')
-def app(request):
+def server(request):
     from .server import Server
     server = Server()
+    yield server
+    server.cv.close()
+
+
+@pytest.fixture(scope='session')
+def app(server):
     return server.app
@@ -1,54 +1,311 @@
 import base64
-import copy
 import datetime
 import io
 import logging
 import os
+import queue
 import random
+import threading
 import time
 
 import cv2
-import imageio
+import gevent.monkey
 import numpy as np
 import qrcode
 import ujson as json
-from flask import Blueprint, abort, request
+from flask import Blueprint, Response, abort, request, stream_with_context
+from prometheus_client import REGISTRY, Counter, Gauge
 from pylab import imshow, show  # noqa F401
 
-from .image_align import align_by_qrcode, get_oriented_image
-from .qr import generate_pdf, read_codes
-from .utils import draw_segments
-from .device_fields import Cleaner, get_fields_info
+from .config import Settings
+from .executor import Executor, Overloaded
+from .image_align import align_frame, align_segments
+from .qr import generate_pdf, read_codes_from
+from .shard import ShardedCleaner
+from .utils import LRUCache, draw_segments_on, encode_image, join_length_prefixed, split_length_prefixed
+from .device_fields import Cleaner, get_fields_info, save_state
 
 np.set_printoptions(precision=3)
 
+# The error of a frame older than the last frame of its monitor
+OUT_OF_ORDER = "Out of order frame, older than the last frame of the monitor"
+# Output image formats: format query parameter -> (extension, content type), jpeg if neither the query nor Accept picks one
+IMAGE_FORMATS = {
+    "jpeg": (".jpg", "image/jpeg"),
+    "jpg": (".jpg", "image/jpeg"),
+    "png": (".png", "image/png"),
+    "webp": (".webp", "image/webp"),
+}
+
 
 class ResultLogger():
+    """
+    Log ocr results (and images) to files, in batches on a background writer, so the disk is not on the request path.
+    Records are queued on a bounded queue, and dropped (and counted) when it is full rather than blocking a request.
+    """
 
-    def __init__(self):
-        self.basedir = './log/'
+    def __init__(self, basedir='./log/', queue_size=1024, batch_size=64, registry=REGISTRY):
+        self.basedir = basedir
         self.index = 0
+        self.batch_size = batch_size
+        self.queue = queue.Queue(queue_size)
+        self.writer = None
+        self.dropped = Counter('cvmonitor_result_log_dropped', 'Number of ocr results not logged since the queue was full', registry=registry)
+        self.queued = Gauge('cvmonitor_result_log_queued', 'Number of ocr results waiting to be logged', registry=registry)
+        self.queued.set_function(self.queue.qsize)
 
     def log_ocr(self, image, segments, server_ocr, imageId=None, monitorId=None):
         self.index += 1
         folder_name = self.basedir + time.strftime("%Y_%m_%d_%H")
-        os.makedirs(folder_name, exist_ok=True)
         fname = f'{folder_name}/{self.index:09}'
         if imageId and monitorId:
             fname = f'{folder_name}/{monitorId}_{imageId}'
-        json.dump({'segments': segments, 'server_ocr': server_ocr}, open(f'{fname}.json', 'w'))
-        if image is not None:
-            with open(f'{fname}.jpg', 'wb') as f:
-                f.write(image)
+        if self.writer is None:
+            self.writer = threading.Thread(target=self.write_forever, name='ResultLogger', daemon=True)
+            self.writer.start()
+        try:
+            self.queue.put_nowait((folder_name, fname, image, {'segments': segments, 'server_ocr': server_ocr}))
+        except queue.Full:
+            self.dropped.inc()
+
+    def write_forever(self):
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            records = [record for record in batch if record is not None]
+            try:
+                if records:
+                    run_blocking(self.write, records)
+            except Exception:
+                logging.exception('Failed to log ocr results')
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+            if len(records) < len(batch):
+                return
+
+    @staticmethod
+    def write(records):
+        for folder_name in {record[0] for record in records}:
+            os.makedirs(folder_name, exist_ok=True)
+        for _, fname, image, result in records:
+            with open(f'{fname}.json', 'w') as f:
+                json.dump(result, f)
+            if image is not None:
+                with open(f'{fname}.jpg', 'wb') as f:
+                    f.write(image)
+
+    def flush(self):
+        """
+        Wait for the queued records to be written
+        """
+        if self.writer is not None:
+            self.queue.join()
+
+    def close(self):
+        """
+        Write the queued records and stop the writer
+        """
+        if self.writer is not None:
+            self.queue.put(None)
+            self.writer.join()
+            self.writer = None
+
+
+def run_blocking(fn, *args):
+    """
+    Run blocking (disk) io on a native thread when the server is gevent patched, so it doesn't block the loop.
+    """
+    if gevent.monkey.is_module_patched('threading'):
+        return gevent.get_hub().threadpool.apply(fn, args)
+    return fn(*args)
+
+
+def make_cleaner(settings, registry=REGISTRY):
+    """
+    The ocr cleaner of the settings, sharded over worker processes if cleaner_shards > 0
+    """
+    if settings.cleaner_shards > 0:
+        return ShardedCleaner(settings.cleaner_shards, settings.monitor_state_size, settings.monitor_state_ttl, registry, settings.history_size)
+    return Cleaner(get_fields_info(), settings.monitor_state_size, settings.monitor_state_ttl, registry, settings.history_size)
+
+
+def or_bad_request(fn, *args, **kwargs):
+    """
+    Call fn (e.g. to parse a request), answer 400 if it raises ValueError
+    """
+    try:
+        return fn(*args, **kwargs)
+    except ValueError as e:
+        abort(400, str(e))
+
+
+def parse_int_arg(args, name, low, high=None):
+    value = args.get(name)
+    if value is None:
+        return None
+    try:
+        value = int(value)
+    except ValueError:
+        raise ValueError(f"{name} should be a number, got {value}")
+    if value < low or (high is not None and value > high):
+        raise ValueError(f"{name} should be in [{low}, {high or 'inf'}], got {value}")
+    return value
+
+
+def output_options(args, accept_mimetypes):
+    """
+    The output image a request asks for: the `format` query parameter (jpeg, png or webp), or else the best of them
+    by the Accept header (jpeg if it accepts none), and the `quality`, `max_dim` and `gray` query parameters.
+    Raises ValueError on bad values.
+    :return: the content type, and the align_frame keyword arguments for it
+    """
+    name = args.get("format")
+    if name is None:
+        content_type = accept_mimetypes.best_match([content_type for _, content_type in IMAGE_FORMATS.values()])
+        name = content_type.split("/")[1] if content_type else "jpeg"
+    if name.lower() not in IMAGE_FORMATS:
+        raise ValueError(f"format should be one of {list(IMAGE_FORMATS)}, got {name}")
+    image_format, content_type = IMAGE_FORMATS[name.lower()]
+    options = {"image_format": image_format}
+    quality = parse_int_arg(args, "quality", 1, 100)
+    if quality is not None:
+        options["quality"] = quality
+    options["max_dim"] = parse_int_arg(args, "max_dim", 1)
+    gray = args.get("gray", "false").lower()
+    if gray not in ("true", "false", "1", "0"):
+        raise ValueError(f"gray should be true or false, got {gray}")
+    options["gray"] = gray in ("true", "1")
+    return content_type, options
+
+
+def read_frames(request, max_frames):
+    """
+    The frames of an /align_images request: multipart files, or one length prefixed body (see split_length_prefixed).
+    Answers 400 on a bad body and 413 on more than max_frames frames.
+    """
+    if request.files:
+        frames = [f.read() for _, f in request.files.items(multi=True)]
+    else:
+        frames = or_bad_request(split_length_prefixed, request.get_data())
+    if len(frames) > max_frames:
+        abort(413, f"Too many frames in one request ({len(frames)} > {max_frames})")
+    return frames
+
+
+def parse_history_args(args):
+    """
+    The sensors and limit of a /history request, raises ValueError on a bad limit
+    """
+    limit = args.get("limit", type=int)
+    if limit is not None and limit < 0:
+        raise ValueError("limit should be at least 0")
+    return args.getlist("sensor") or None, limit
+
+
+def parse_ocr_batch(items):
+    """
+    The items of a /run_ocr_batch body that are objects, and the errors of the others keyed by their index
+    (e.g. "#3"), raises ValueError if the body is not an array
+    """
+    if not isinstance(items, list):
+        raise ValueError("Expected an array of ocr results")
+    errors = {
+        f"#{i}": {"error": "Expected an object with monitorId, imageId and segments"}
+        for i, data in enumerate(items) if not isinstance(data, dict)
+    }
+    return [data for data in items if isinstance(data, dict)], errors
+
+
+def ocr_result(cleaned_segments):
+    """
+    The segments of a cleaned frame, or its error (see ComputerVision.process_ocr_batch)
+    """
+    if isinstance(cleaned_segments, Exception):
+        return {"error": str(cleaned_segments)}
+    if cleaned_segments is None:
+        return {"error": OUT_OF_ORDER}
+    return cleaned_segments
+
+
+def parse_segments_body(data):
+    """
+    The image and segments of a /align_segments body, raises ValueError on a bad one
+    :return: the decoded image bytes, and the list of segment dicts
+    """
+    if not isinstance(data, dict) or not isinstance(data.get("image"), str) or not isinstance(data.get("segments"), list):
+        raise ValueError("Expected an object with a base64 image and segments")
+    for i, segment in enumerate(data["segments"]):
+        if not isinstance(segment, dict):
+            raise ValueError(f"Segment {i} should be an object with a name, left, top, right and bottom")
+    # a bad base64 image raises binascii.Error, a ValueError
+    return base64.b64decode(data["image"]), data["segments"]
+
+
+def read_segments(request, max_segments):
+    """
+    The image and segments of an /align_segments request (see parse_segments_body).
+    Answers 400 on a bad body and 413 on more than max_segments segments.
+    """
+    image, segments = or_bad_request(parse_segments_body, request.json)
+    if len(segments) > max_segments:
+        abort(413, f"Too many segments in one request ({len(segments)} > {max_segments})")
+    return image, segments
+
+
+def image_response(encoded, content_type, headers=None):
+    """
+    Respond with an encoded image (see utils.encode_image), the server sends it from the array without copying it to bytes
+    """
+    return chunks_response([memoryview(encoded).cast('B')], content_type, headers)
+
+
+def chunks_response(chunks, content_type, headers=None):
+    """
+    Respond with a body made of chunks (bytes like), sent one after the other without joining them
+    """
+    length = sum(memoryview(chunk).nbytes for chunk in chunks)
+    headers = dict(headers or {}, **{"content-type": content_type, "content-length": str(length)})
+    return Response(chunks, 200, headers)
 
 
 class ComputerVision:
-    def __init__(self):
+    def __init__(self, settings=None, registry=REGISTRY):
+        settings = settings or Settings.from_env()
+        self.qr_cache = LRUCache(settings.qr_cache_size, settings.qr_cache_ttl)
+        # Sharding is only set at startup, the number of shards can be changed on reload
+        self.sharded = settings.cleaner_shards > 0
+        self.cleaner = make_cleaner(settings, registry)
+        self.settings = settings
         self.blueprint = Blueprint("cv", __name__)
         self.qrDecoder = cv2.QRCodeDetector()
         self.devices = get_fields_info()
-        self.cleaner = Cleaner(get_fields_info())
-        self.resultsLogger = ResultLogger()
+        self.resultsLogger = ResultLogger(queue_size=settings.result_log_queue_size, registry=registry)
+        self.executor = Executor(
+            self.settings.workers,
+            self.settings.worker_queue_size,
+            registry,
+        )
+        self.qr_stages = Counter("cvmonitor_qr_stage", "Number of qr codes found by each search stage", ["stage"], registry=registry)
+        self.qr_cache_hits = Counter("cvmonitor_qr_cache_hits", "Number of qr codes found where they were in the previous frame", registry=registry)
+        self.ocr_out_of_order = Counter(
+            "cvmonitor_ocr_out_of_order", "Number of ocr frames dropped since they were older than the last frame of their monitor", registry=registry
+        )
+        self.qr_cache_misses = Counter("cvmonitor_qr_cache_misses", "Number of frames that needed a full qr code search", registry=registry)
+        self.monitor_states = Gauge("cvmonitor_monitor_states", "Number of monitors with ocr state", registry=registry)
+        self.monitor_states.set_function(self.cleaner.count_monitors)
+        self.monitor_state_bytes = Gauge("cvmonitor_monitor_state_bytes", "Approximate memory held by the monitors ocr state", registry=registry)
+        self.monitor_state_bytes.set_function(self.cleaner.monitors_nbytes)
+        # The snapshot path is only read at startup
+        self.state_snapshot = settings.state_snapshot
+        self.snapshot_stop = threading.Event()
+        self.snapshotter = None
+        if self.state_snapshot:
+            self.start_snapshots()
 
         @self.blueprint.route("/ping/")
         def ping():
@@ -87,8 +344,7 @@ class ComputerVision:
                                     right:
                                         type: number
             """
-            image = np.asarray(imageio.imread(request.data))
-            codes = read_codes(image)
+            codes = self.run(read_codes_from, request.get_data(cache=False))
             return json.dumps(codes), 200, {"content-type": "application/json"}
 
         @self.blueprint.route("/align_image", methods=["POST"])
@@ -96,7 +352,36 @@ class ComputerVision:
             """
             Given a jpeg image with that containes the  QR code, use that QR code to align the image
             ---
-            description: Gets a jpeg and returns a jpeg
+            description: Gets a jpeg and returns a jpeg (or the format asked for by the format query parameter or the
+                Accept header).
+                Send the X-MONITOR-ID of the previous response with the next frame of the same monitor,
+                so the qr code is first looked for where it was in that frame.
+            parameters:
+            - in: header
+              name: X-MONITOR-ID
+              schema:
+                  type: string
+                  required: false
+            - in: query
+              name: format
+              description: jpeg, png or webp, by default the best of them in the Accept header, or jpeg
+              schema:
+                  type: string
+            - in: query
+              name: quality
+              description: jpeg or webp quality, 1-100 (default CVMONITOR_JPEG_QUALITY)
+              schema:
+                  type: integer
+            - in: query
+              name: max_dim
+              description: downscale the image (in the alignment warp) to at most this many pixels on each side
+              schema:
+                  type: integer
+            - in: query
+              name: gray
+              description: return a grayscale image
+              schema:
+                  type: boolean
             requestBody:
                 content:
                     image/png:
@@ -113,50 +398,150 @@ class ComputerVision:
                         format: binary
 
             """
-            use_exif = os.environ.get("CVMONITOR_ORIENT_BY_EXIF", "TRUE") == "TRUE"
-            use_qr = os.environ.get("CVMONITOR_ORIENT_BY_QR", "FALSE") == "TRUE"
-            qrprefix = str(os.environ.get("CVMONITOR_QR_PREFIX", "cvmonitor"))
-            qrsize = int(os.environ.get("CVMONITOR_QR_TARGET_SIZE", 100))
-            boundery = float(os.environ.get("CVMONITOR_QR_BOUNDERY_SIZE", 50))
-            align_image_by_qr = (
-                os.environ.get("CVMONITOR_SKIP_ALIGN", "TRUE") == "FALSE"
-            )
-            save_before_align = os.environ.get("CVMONITOR_SAVE_BEFORE_ALIGN") == "TRUE"
-            save_after_align = os.environ.get("CVMONITOR_SAVE_AFTER_ALIGN") == "TRUE"
-
-            imdata = io.BytesIO(request.data)
-            image, detected_qrcode, _ = get_oriented_image(
-                imdata, use_exif=use_exif, use_qr=use_qr
-            )
-
-            headers = {"content-type": "image/jpeg"}
-            if save_before_align:
-                imdata.seek(0)
+            settings = self.settings
+            content_type, output = or_bad_request(output_options, request.args, request.accept_mimetypes)
+            # not cached on the request, so the frame is freed once it is aligned
+            data = request.get_data(cache=False)
+            if settings.save_before_align:
                 with open("original_image.jpg", "wb") as f:
-                    f.write(imdata)
-
-            if detected_qrcode is None:
-                if align_image_by_qr:
-                    abort(
-                        400,
-                        "Could not align the image by qr code, no such code detected",
-                    )
-            else:
-                headers["X-MONITOR-ID"] = detected_qrcode.data.decode()
+                    f.write(data)
+
+            qr_hint = self.get_qr_hint(request.headers.get("X-MONITOR-ID"))
+            result = or_bad_request(self.run, align_frame, data, qr_hint=qr_hint, **dict(settings.align_options(), **output))
+            del data
+            self.record_alignment(result, qr_hint)
+            image, monitor_id = result["image"], result["monitorId"]
+
+            # the format may come from the Accept header, caches should key on it
+            headers = {"Vary": "Accept"}
+            if monitor_id is not None:
+                headers["X-MONITOR-ID"] = monitor_id
+
+            if settings.save_after_align:
+                with open("aligned_image.jpg", "wb") as f:
+                    f.write(image)
+
+            return image_response(image, content_type, headers)
+
+        @self.blueprint.route("/align_segments", methods=["POST"])
+        def align_segments_tiles():
+            """
+            Align the segments of an image by its QR code, returning only their tiles
+            ---
+            description: Gets a jpeg (base64) and the boxes of its segments in aligned coordinates (as in the image
+                returned by /align_image), and returns only the aligned segments, each warped on its own from the
+                original image, rather than the whole aligned image.
+                The response is a sequence of parts, each prefixed by its length (4 bytes, big endian):
+                first a json array of the segments (name, left, top, right and bottom, clipped to the aligned image),
+                then the image of each segment in the same order (jpeg, or the format query parameter).
+                Send the X-MONITOR-ID of the previous response with the next frame of the same monitor,
+                as for /align_image.
+            parameters:
+            - in: header
+              name: X-MONITOR-ID
+              schema:
+                  type: string
+                  required: false
+            - in: query
+              name: format
+              description: jpeg, png or webp
+              schema:
+                  type: string
+            - in: query
+              name: quality
+              schema:
+                  type: integer
+            - in: query
+              name: gray
+              schema:
+                  type: boolean
+            requestBody:
+                content:
+                    application/json:
+                      schema:
+                        type: object
+                        properties:
+                            image:
+                                type: string
+                                contentEncoding: base64
+                                contentMediaType: image/jpeg
+                            segments:
+                                type: array
+                                items:
+                                    type: object
+                                    properties:
+                                        name:
+                                            type: string
+                                        top:
+                                            type: number
+                                        left:
+                                            type: number
+                                        bottom:
+                                            type: number
+                                        right:
+                                            type: number
+            responses:
+              '200':
+                description: the segments and their images, length prefixed
+                content:
+                    application/octet-stream:
+                      schema:
+                        type: string
+                        format: binary
+            """
+            settings = self.settings
+            image, segments = read_segments(request, settings.align_max_segments)
+            _, output = or_bad_request(output_options, request.args, request.accept_mimetypes)
+            output.pop("max_dim")
+            options = dict(settings.align_options(), max_pixels=settings.align_max_segment_pixels, **output)
+            del options["align"], options["remap_cache_size"]
 
-            if align_image_by_qr:
-                logging.debug("Trying to align image by qr code")
-                image, _ = align_by_qrcode(
-                    image, detected_qrcode, qrsize, boundery, qrprefix
-                )
+            qr_hint = self.get_qr_hint(request.headers.get("X-MONITOR-ID"))
+            result = or_bad_request(self.run, align_segments, image, segments, qr_hint=qr_hint, **options)
+            self.record_alignment(result, qr_hint)
 
-            if save_after_align:
-                imageio.imwrite("aligned_image.jpg", image)
+            chunks = join_length_prefixed([json.dumps(result["segments"]).encode()] + result["tiles"])
+            return chunks_response(chunks, "application/octet-stream", {"X-MONITOR-ID": result["monitorId"], "Vary": "Accept"})
 
-            b = io.BytesIO()
-            imageio.imwrite(b, image, format="jpeg")
-            b.seek(0)
-            return b.read(), 200, headers
+        @self.blueprint.route("/align_images", methods=["POST"])
+        def align_images():
+            """
+            Align a batch of jpeg images, each by the QR code it contains
+            ---
+            description: Gets many jpegs, either as multipart files or as one body where each image is prefixed
+                by its length (4 bytes, big endian), and returns the aligned jpegs in the same order.
+                A frame that fails returns an error instead of failing the whole request.
+            requestBody:
+                content:
+                    multipart/form-data:
+                      schema:
+                        type: object
+                    application/octet-stream:
+                      schema:
+                        type: string
+                        format: binary
+            responses:
+              '200':
+                description: aligned images
+                content:
+                    application/json:
+                        schema:
+                            type: array
+                            items:
+                                type: object
+                                properties:
+                                    monitorId:
+                                        type: string
+                                    image:
+                                        type: string
+                                        contentEncoding: base64
+                                        contentMediaType: image/jpeg
+                                    error:
+                                        type: string
+            """
+            settings = self.settings
+            frames = read_frames(request, settings.align_max_frames)
+            return json.dumps(self.align_batch(frames, settings.align_options())), 200, {"content-type": "application/json"}
 
         @self.blueprint.route("/run_ocr", methods=["POST"])
         def run_ocr():
@@ -174,6 +559,13 @@ class ComputerVision:
                                 type: string
                                 contentEncoding: base64
                                 contentMediaType: image/jpeg
+                            monitorId:
+                                type: string
+                            imageId:
+                                type: string
+                            timestamp:
+                                type: string
+                                description: capture time of the frame, ISO 8601 (UTC if no timezone) or seconds since the epoch
                             segments:
                                 type: array
                                 items:
@@ -205,29 +597,156 @@ class ComputerVision:
                                     type: string
                                 value:
                                     type: string
+              '409':
+                description: the frame is older than the last frame of the monitor, it was dropped
             """
-            data = request.json
-            monitorId = data.get("monitorId")
-            imageId = data.get("imageId")
-            logging.debug(f'id: {data.get("monitorId")}:{data.get("imageId")}')
-
-            segments = copy.deepcopy(data.get("segments", []))
-            logging.debug(f'Recived segments {segments}')
-            cleaned_segments = self.cleaner.clean_segments(copy.deepcopy(segments), monitorId, imageId)
-            logging.debug(f'Cleaned segments {cleaned_segments}')
-            try:
-                imageId = int(imageId)
-            except Exception:
-                imageId = None
-            # Randomly log some images:
-            rnum = random.randint(0, 10)
-            if (imageId and ((imageId % 20) == 0 or (imageId % 20) == 1)) or rnum == 5:
-                if 'image' in data:
-                    del data['image']
-                self.resultsLogger.log_ocr(None, None, {'cleaned': cleaned_segments,
-                                                        "process_time":  datetime.datetime.isoformat(datetime.datetime.now())}, imageId, monitorId)
+            cleaned_segments = self.process_ocr(request.json)
+            if cleaned_segments is None:
+                abort(409, OUT_OF_ORDER)
             return json.dumps(cleaned_segments), 200, {"content-type": "application/json"}
 
+        @self.blueprint.route("/run_ocr_batch", methods=["POST"])
+        def run_ocr_batch():
+            """
+            Process ocr results of many monitors
+            ---
+            description: Process the ocr results of many monitors in one call.
+                Gets an array of /run_ocr bodies (monitorId, imageId, segments) and returns the cleaned segments
+                keyed by monitorId. A monitor sent more than once is cleaned frame by frame in order, and gets the
+                result of its last frame. An item that fails gets an error instead, an item that is not an object
+                gets an error keyed by its index in the array, e.g. "#3".
+            requestBody:
+                content:
+                    application/json:
+                      schema:
+                        type: array
+                        items:
+                            type: object
+                            properties:
+                                monitorId:
+                                    type: string
+                                imageId:
+                                    type: string
+                                segments:
+                                    type: array
+                                    items:
+                                        type: object
+            responses:
+              '200':
+                description: ocr results by monitorId
+                content:
+                    application/json:
+                      schema:
+                        type: object
+                        additionalProperties:
+                            oneOf:
+                                - type: array
+                                  items:
+                                    type: object
+                                - type: object
+                                  properties:
+                                    error:
+                                        type: string
+            """
+            items, results = or_bad_request(parse_ocr_batch, request.json)
+            results.update(self.ocr_batch(items))
+            return json.dumps(results), 200, {"content-type": "application/json"}
+
+        @self.blueprint.route("/run_ocr_stream", methods=["POST"])
+        def run_ocr_stream():
+            """
+            Process a stream of ocr results on one connection
+            ---
+            description: Process ocr results of many frames on one long lived (chunked) request.
+                Each line of the body is a json message like the /run_ocr body (monitorId, imageId, segments),
+                and each line of the response is the result of the message on the same line, in order,
+                sent as soon as it is ready. A bad message answers an error instead of ending the stream.
+            requestBody:
+                content:
+                    application/x-ndjson:
+                      schema:
+                        type: string
+            responses:
+              '200':
+                description: one result per line
+                content:
+                    application/x-ndjson:
+                      schema:
+                        type: object
+                        properties:
+                            monitorId:
+                                type: string
+                            imageId:
+                                type: string
+                            segments:
+                                type: array
+                                items:
+                                    type: object
+                            error:
+                                type: string
+            """
+            return Response(stream_with_context(self.stream_ocr(request.stream)), 200, {"content-type": "application/x-ndjson"})
+
+        @self.blueprint.route("/monitor_state/<monitorId>", methods=["DELETE"])
+        def delete_monitor_state(monitorId):
+            """
+            Forget the ocr state of a monitor
+            ---
+            description: forget the recent values of a monitor, e.g. when it moves to another patient
+            parameters:
+            - in: path
+              name: monitorId
+              schema:
+                  type: string
+                  required: true
+            responses:
+              '204':
+                description: the state was removed
+              '404':
+                description: no such monitor
+            """
+            if not self.cleaner.forget(monitorId):
+                abort(404, f"No state for monitor {monitorId}")
+            return "", 204
+
+        @self.blueprint.route("/history/<monitorId>", methods=["GET"])
+        def history(monitorId):
+            """
+            Get the recent values of a monitor
+            ---
+            description: the last valid values of the sensors of a monitor, oldest first, and their mode, median, min and max
+            parameters:
+            - in: path
+              name: monitorId
+              schema:
+                  type: string
+                  required: true
+            - in: query
+              name: sensor
+              description: only return these sensors (may be repeated)
+              schema:
+                  type: string
+            - in: query
+              name: limit
+              description: the number of values of each sensor to return
+              schema:
+                  type: integer
+            responses:
+              '200':
+                description: the history of every sensor
+                content:
+                    application/json:
+                      schema:
+                        type: object
+              '404':
+                description: no such monitor
+            """
+            sensors, limit = or_bad_request(parse_history_args, request.args)
+            history = self.cleaner.history(monitorId, sensors, limit)
+            if history is None:
+                abort(404, f"No state for monitor {monitorId}")
+            return json.dumps({"monitorId": monitorId, "sensors": history}), 200, {"content-type": "application/json"}
+
         @self.blueprint.route("/show_ocr/", methods=["POST"])
         def show_ocr():
             """
@@ -278,18 +797,9 @@ class ComputerVision:
             """
             data = request.json
             assert "image" in data
-            image = np.asarray(
-                imageio.imread(base64.decodebytes(data["image"].encode()))
-            )
             # Suggest segments
-            if data.get("segments"):
-                image = draw_segments(image, data.get('segments'))
-
-            headers = {"content-type": "image/jpeg"}
-            b = io.BytesIO()
-            imageio.imwrite(b, image, format="jpeg")
-            b.seek(0)
-            return b.read(), 200, headers
+            image = self.run(draw_segments_on, base64.decodebytes(data["image"].encode()), data.get("segments"), self.settings.jpeg_quality)
+            return image_response(image, "image/jpeg")
 
         @self.blueprint.route("/qr/<title>", methods=["GET"])
         def qr(title):
@@ -337,10 +847,26 @@ class ComputerVision:
                 "Content-Disposition": 'attachment; filename="random-qr.pdf"',
             }
             pdf_buffer = io.BytesIO()
-            generate_pdf(pdf_buffer, title, width, height)
+            generate_pdf(pdf_buffer, title, width or self.settings.qr_pdf_cols, height or self.settings.qr_pdf_rows)
             pdf_buffer.seek(0)
             return pdf_buffer.read(), 200, headers
 
+        @self.blueprint.route("/config", methods=["GET"])
+        def get_config():
+            """
+            Get the current server configuration
+            ---
+            description: get the configuration, parsed from the CVMONITOR_* environment variables
+            responses:
+              '200':
+                description: configuration
+                content:
+                    application/json:
+                      schema:
+                        type: object
+            """
+            return json.dumps(self.settings._asdict()), 200, {"content-type": "application/json"}
+
         @self.blueprint.route("/measurements/<device>", methods=["GET"])
         def get_measurements(device):
             return json.dumps([x for x in get_fields_info([device]).keys()]), 200, {'content-type': 'application/json'}
@@ -365,15 +891,204 @@ class ComputerVision:
                 content:
                     image/png:
             """
-            headers = {
-                "Content-Type": "image/png",
-            }
-            buffer = io.BytesIO()
             qr = qrcode.QRCode(error_correction=qrcode.constants.ERROR_CORRECT_L)
             qr.add_data(monitorId)
             qr.make(fit=True)
             img = qr.make_image(fill_color="black", back_color="white")
             image = np.array(img).astype(np.uint8)*255
-            imageio.imwrite(buffer, image, format='png')
-            buffer.seek(0)
-            return buffer.read(), 200, headers
+            return image_response(encode_image(image, ".png"), "image/png")
+
+    def align_batch(self, frames, options):
+        """
+        Align many frames on the executor, a frame that fails (or doesn't fit in its queue) gets an error
+        :return: list of {monitorId, image (base64), error}, in the order of the frames
+        """
+        futures = []
+        for frame in frames:
+            try:
+                futures.append(self.executor.submit(align_frame, frame, **options))
+            except Overloaded as e:
+                futures.append(e)
+        results = []
+        for future in futures:
+            try:
+                if isinstance(future, Exception):
+                    raise future
+                result = future.result()
+                self.record_alignment(result)
+                results.append({"monitorId": result["monitorId"], "image": base64.b64encode(result["image"]).decode(), "error": None})
+            except Exception as e:
+                results.append({"monitorId": None, "image": None, "error": str(e)})
+        return results
+
+    def ocr_batch(self, items):
+        """
+        The result of every monitor of a batch of frames (see ocr_result) keyed by monitorId,
+        a monitor sent more than once gets the result of its last frame that is not out of order
+        """
+        results = {}
+        for data, cleaned_segments in zip(items, self.process_ocr_batch(items)):
+            if cleaned_segments is not None or str(data.get("monitorId")) not in results:
+                results[str(data.get("monitorId"))] = ocr_result(cleaned_segments)
+        return results
+
+    def stream_ocr(self, lines):
+        """
+        Clean the ocr segments of a stream of json lines, yield the json line of the result of each,
+        a bad line gets an error instead of ending the stream
+        """
+        for line in lines:
+            if not line.strip():
+                continue
+            try:
+                data = json.loads(line)
+                result = {"monitorId": data.get("monitorId"), "imageId": data.get("imageId")}
+                cleaned_segments = self.process_ocr(data)
+                if cleaned_segments is not None:
+                    result["segments"] = cleaned_segments
+                else:
+                    result["error"] = OUT_OF_ORDER
+            except Exception as e:
+                result = {"error": str(e)}
+            yield json.dumps(result) + "\n"
+
+    def process_ocr(self, data):
+        """
+        Clean the ocr segments of one frame
+        :param data: dict with the monitorId, imageId and segments
+        """
+        cleaned_segments = self.process_ocr_batch([data])[0]
+        if isinstance(cleaned_segments, Exception):
+            raise cleaned_segments
+        return cleaned_segments
+
+    def process_ocr_batch(self, items):
+        """
+        Clean the ocr segments of many frames, in parallel on the cleaner shards if it is sharded
+        :param items: list of dicts with the monitorId, imageId, segments and optionally the timestamp of the frame
+        :return: the cleaned segments of every frame, None for a frame older than the last frame of its monitor,
+            the exception of a frame whose cleaner shard failed (see ShardedCleaner.clean_batch)
+        """
+        for data in items:
+            logging.debug(f'id: {data.get("monitorId")}:{data.get("imageId")}')
+            logging.debug(f'Recived segments {data.get("segments", [])}')
+        cleaned = self.cleaner.clean_batch(
+            [(data.get("monitorId"), data.get("imageId"), data.get("segments", []), data.get("timestamp")) for data in items]
+        )
+        for data, cleaned_segments in zip(items, cleaned):
+            if isinstance(cleaned_segments, Exception):
+                logging.error(f'Failed to clean {data.get("monitorId")}:{data.get("imageId")}: {cleaned_segments}')
+                continue
+            if cleaned_segments is None:
+                logging.debug(f'Dropped out of order frame {data.get("monitorId")}:{data.get("imageId")}')
+                self.ocr_out_of_order.inc()
+                continue
+            logging.debug(f'Cleaned segments {cleaned_segments}')
+            self.sample_ocr(data, cleaned_segments)
+        return cleaned
+
+    def sample_ocr(self, data, cleaned_segments):
+        """
+        Log some of the ocr results
+        """
+        monitorId = data.get("monitorId")
+        try:
+            imageId = int(data.get("imageId"))
+        except Exception:
+            imageId = None
+        # Randomly log some images:
+        rnum = random.randint(0, 10)
+        if (imageId and ((imageId % 20) == 0 or (imageId % 20) == 1)) or rnum == 5:
+            if 'image' in data:
+                del data['image']
+            self.resultsLogger.log_ocr(None, None, {'cleaned': cleaned_segments,
+                                                    "process_time":  datetime.datetime.isoformat(datetime.datetime.now())}, imageId, monitorId)
+
+    def run(self, fn, *args, **kwargs):
+        """
+        Run cpu bound work on the executor, answer 503 if it is overloaded
+        """
+        try:
+            return self.executor.run(fn, *args, **kwargs)
+        except Overloaded as e:
+            abort(503, str(e))
+
+    @property
+    def settings(self):
+        return self._settings
+
+    @settings.setter
+    def settings(self, settings):
+        self._settings = settings
+        self.qr_cache.resize(settings.qr_cache_size, settings.qr_cache_ttl)
+        self.cleaner.resize(settings.monitor_state_size, settings.monitor_state_ttl, settings.history_size)
+        if self.sharded and settings.cleaner_shards > 0:
+            self.cleaner.resize_shards(settings.cleaner_shards)
+
+    def get_qr_hint(self, monitor_id):
+        """
+        Where the qr code was in the last frame of monitor_id, if it is still cached
+        """
+        if not monitor_id:
+            return None
+        qr_hint = self.qr_cache.get(monitor_id)
+        if qr_hint is None:
+            self.qr_cache_misses.inc()
+        return qr_hint
+
+    def record_alignment(self, result, qr_hint=None):
+        """
+        Count the qr search stage and cache hit of an align_frame result, and cache where its qr code is
+        """
+        if result["qr_stage"]:
+            self.qr_stages.labels(result["qr_stage"]).inc()
+        if qr_hint is not None:
+            if result["qr_stage"] == "cached":
+                self.qr_cache_hits.inc()
+            else:
+                self.qr_cache_misses.inc()
+        if result["qr"] is not None:
+            self.qr_cache.set(result["monitorId"], result["qr"])
+
+    def restore_state(self):
+        """
+        Warm start the ocr cleaning from the last snapshot, if there is one
+        """
+        if not os.path.exists(self.state_snapshot):
+            return
+        try:
+            count = self.cleaner.load_state(self.state_snapshot)
+            logging.info(f'Restored the state of {count} monitors from {self.state_snapshot}')
+        except Exception:
+            logging.exception(f'Could not restore the state from {self.state_snapshot}')
+
+    def snapshot_state(self):
+        """
+        Write a snapshot of the ocr cleaning state, the disk io runs off the request path
+        """
+        try:
+            run_blocking(save_state, self.state_snapshot, self.cleaner.get_state())
+        except Exception:
+            logging.exception(f'Could not write the state snapshot {self.state_snapshot}')
+
+    def start_snapshots(self):
+        """
+        Restore the ocr state from the snapshot, and snapshot it in the background from now on
+        """
+        self.restore_state()
+        self.snapshotter = threading.Thread(target=self.snapshot_forever, name='StateSnapshot', daemon=True)
+        self.snapshotter.start()
+
+    def snapshot_forever(self):
+        while not self.snapshot_stop.wait(self.settings.state_snapshot_interval):
+            self.snapshot_state()
+
+    def close(self):
+        self.executor.close()
+        self.resultsLogger.close()
+        if self.snapshotter is not None:
+            self.snapshot_stop.set()
+            self.snapshotter.join()
+            self.snapshotter = None
+            self.snapshot_state()
+        self.cleaner.close()
@@ -1,10 +1,16 @@
+import os
 import random
 import re
 import copy
+import logging
+import math
+import time
 import traceback
-from collections import Counter, defaultdict
-from cvmonitor.aug_clean import MonitorValues
-from .utils import is_int
+from collections import Counter
+import numpy as np
+from prometheus_client import Counter as PrometheusCounter
+from cvmonitor.aug_clean import MonitorValues, SensorStore
+from .utils import LRUCache, parse_timestamp
 
 
 def get_fields_info(device_types=['respirator', 'ivac', 'monitor']):
@@ -85,30 +91,44 @@ def get_field_rand_value(field_info, current=None):
     return base
 
 
-def cleanup_field(field_info, field_value):
-    res = ''
+# A client timestamp later than this many seconds after the server time is ignored
+MAX_CLOCK_SKEW = 10.0
+NON_DIGITS = re.compile(r'\D+')
+NON_DECIMALS = re.compile(r'[^\d.]+')
+
+
+def compile_field_cleaner(field_info):
+    """
+    Build the cleaner of a field from its get_fields_info entry, with its patterns compiled once.
+    :return: a function that takes an ocr value and returns the cleaned value (a string, '' if nothing is left)
+    """
     if field_info.get('regex'):
-        regex_res = re.match(field_info.get('regex'), field_value or '')
-        if not regex_res:
-            return ''
-        if field_info.get('sub'):
-            return re.sub(field_info.get('regex'), field_info.get('sub'), field_value or '')
-        return ''.join(regex_res.groups())
+        pattern = re.compile(field_info['regex'])
+        sub = field_info.get('sub')
+
+        def clean_regex(field_value):
+            field_value = field_value or ''
+            match = pattern.match(field_value)
+            if not match:
+                return ''
+            if not sub:
+                return ''.join(match.groups())
+            if match.end() == len(field_value):
+                return match.expand(sub)
+            return pattern.sub(sub, field_value)
+        return clean_regex
+    max_len = field_info.get('max_len', 10)
     if field_info.get('dtype') == str:
-        res = field_value
+        return lambda field_value: field_value
     if field_info.get('dtype') == int:
-        for c in field_value:
-            if is_int(c):
-                res += c
-                if len(res) >= field_info.get('max_len', 10):
-                    break
+        return lambda field_value: NON_DIGITS.sub('', field_value)[:max_len]
     if field_info.get('dtype') == float:
-        for c in field_value:
-            if is_int(c) or c == '.':
-                res += c
-                if len(res) >= field_info.get('max_len', 10)+1:
-                    break
-    return res
+        return lambda field_value: NON_DECIMALS.sub('', field_value)[:max_len + 1]
+    return lambda field_value: ''
+
+
+def cleanup_field(field_info, field_value):
+    return compile_field_cleaner(field_info)(field_value)
 
 
 # Currently unused, replaced with Cleaner
@@ -185,42 +205,122 @@ class PostProcessor():
         return resseg
 
 
+class Segment:
+    """
+    A named segment of a frame, merged from its ocr augmentations, as the Cleaner sees it.
+    Copy on write: the fields of the first input segment with the name are shared, not copied, and the cleaner
+    only sets its own attributes, so the input segments are never modified.
+    """
+    __slots__ = ('fields', 'name', 'values', 'location')
+
+    def __init__(self, fields, name, values=None, location=None):
+        self.fields = fields
+        self.name = name
+        # the cleaned value of each augmentation
+        self.values = values if values is not None else []
+        # the location of the crop level augmentation, if any
+        self.location = location
+
+    def renamed(self, name, values):
+        return Segment(self.fields, name, values, self.location)
+
+    def to_dict(self, value):
+        """
+        The output segment, with the same fields in the same order as the input segment
+        """
+        segment = dict(self.fields)
+        segment["name"] = self.name
+        segment["value"] = value
+        if self.location is not None:
+            segment.update(self.location)
+        return segment
+
+
 class Cleaner:
+    """
+    Clean the ocr segments of frames, keeping the recent valid values of each monitor.
+    At most `max_monitors` monitors are kept, the least recently seen is evicted first,
+    and a monitor not seen for `ttl` seconds is forgotten.
+    The last `history_size` valid readings of every numeric sensor of a monitor are kept for history().
+    Times are the capture times of the frames (their timestamp) when they have one, otherwise when they are cleaned.
+    """
 
-    def __init__(self, sensors):
+    def __init__(self, sensors, max_monitors=1024, ttl=None, registry=None, history_size=0):
         self.sensors = sensors
-        self.monitors = defaultdict(lambda: MonitorValues(sensors))
+        self.history_size = history_size
+        # wall clock - monotonic clock, to compare timestamps with the time.monotonic() times of the state
+        self.clock_offset = time.time() - time.monotonic()
+        self.overlaps = None
+        if registry is not None:
+            self.overlaps = PrometheusCounter(
+                'cvmonitor_sensor_overlaps', 'Number of ocr values dropped since another sensor had the same value', ['sensor'], registry=registry
+            )
+        self.cleaners = {name: compile_field_cleaner(info) for name, info in sensors.items()}
+        self.store = SensorStore(sensors)
+        self.monitors = LRUCache(max_monitors, ttl, on_remove=lambda monitorId, mv: mv.release())
+
+    def get_monitor(self, monitorId):
+        """
+        The values of a monitor, a frame without a monitorId gets values of its own that are not kept
+        """
+        if monitorId is None:
+            return MonitorValues(self.sensors, overlaps=self.overlaps)
+        mv = self.monitors.get(monitorId)
+        if mv is None:
+            mv = MonitorValues(self.sensors, self.store, self.overlaps, self.history_size)
+        # (re)set, so the ttl counts from the last frame of the monitor
+        self.monitors.set(monitorId, mv)
+        return mv
+
+    def forget(self, monitorId):
+        """
+        Drop the values of a monitor, returns whether it was known
+        """
+        return self.monitors.pop(monitorId) is not None
+
+    def count_monitors(self):
+        self.monitors.expire()
+        return len(self.monitors)
+
+    def monitors_nbytes(self):
+        self.monitors.expire()
+        return self.store.nbytes() + sum(mv.history_nbytes() for mv in self.monitors.values())
+
+    def history(self, monitorId, sensors=None, limit=None):
+        """
+        The recent valid readings of the sensors of a monitor (all of them by default) and their statistics
+        :param limit: the number of readings of each sensor to return, all of the window by default
+        :return: {sensor: {times, values, mode, median, min, max}}, or None if the monitor is unknown
+        """
+        # a read, it doesn't refresh the monitor
+        mv = self.monitors.peek(monitorId)
+        if mv is None:
+            return None
+        result = {}
+        for name, history in mv.histories.items():
+            if sensors and name not in sensors:
+                continue
+            times, values = history.series(limit)
+            result[name] = dict(
+                times=(times + self.clock_offset).tolist(),
+                values=values.tolist(),
+                mode=history.mode(),
+                median=history.median(),
+                min=history.min(),
+                max=history.max(),
+            )
+        return result
 
     def sysdis(self, segments_dict):
-        if "IBP" in segments_dict and "IBP-Systole" not in segments_dict and "IBP-Diastole" not in segments_dict:
-            values = segments_dict["IBP"]["value"]
-            if values and isinstance(values, list):
-                values = [v for v in values if v and isinstance(v, str)]
-                if all(['/' in v for v in values]):
-                    systole = copy.deepcopy(segments_dict["IBP"])
-                    systole["value"] = [x.split("/")[0] for x in values]
-                    diastole = copy.deepcopy(segments_dict["IBP"])
-                    diastole["value"] = [x.split("/")[-1] for x in values]
-                    systole["name"] = "IBP-Systole"
-                    diastole["name"] = "IBP-Diastole"
-                    segments_dict["IBP-Systole"] = systole
-                    segments_dict["IBP-Diastole"] = diastole
-                    del segments_dict["IBP"]
-
-        if "NIBP" in segments_dict and "NIBP-Systole" not in segments_dict and "NIBP-Diastole" not in segments_dict:
-            values = segments_dict["NIBP"]["value"]
-            if values and isinstance(values, list):
-                values = [v for v in values if v and isinstance(v, str)]
-                if all(['/' in v for v in values]):
-                    systole = copy.deepcopy(segments_dict["NIBP"])
-                    systole["value"] = [x.split("/")[0] for x in values]
-                    diastole = copy.deepcopy(segments_dict["NIBP"])
-                    diastole["value"] = [x.split("/")[-1] for x in values]
-                    systole["name"] = "NIBP-Systole"
-                    diastole["name"] = "NIBP-Diastole"
-                    segments_dict["NIBP-Systole"] = systole
-                    segments_dict["NIBP-Diastole"] = diastole
-                    del segments_dict["NIBP"]
+        for name in ("IBP", "NIBP"):
+            if name in segments_dict and f"{name}-Systole" not in segments_dict and f"{name}-Diastole" not in segments_dict:
+                values = segments_dict[name].values
+                if values and isinstance(values, list):
+                    values = [v for v in values if v and isinstance(v, str)]
+                    if all(['/' in v for v in values]):
+                        segment = segments_dict.pop(name)
+                        segments_dict[f"{name}-Systole"] = segment.renamed(f"{name}-Systole", [x.split("/")[0] for x in values])
+                        segments_dict[f"{name}-Diastole"] = segment.renamed(f"{name}-Diastole", [x.split("/")[-1] for x in values])
 
     def basic_cleanup(self, segments):
         segments_dict = {}
@@ -230,52 +330,163 @@ class Cleaner:
                 if name is None or not name:
                     continue
                 if name not in segments_dict:
-                    segments_dict[name] = copy.deepcopy(segment)
-                    segments_dict[name]["value"] = list()
+                    segments_dict[name] = Segment(segment, name)
                 cleaned_field = segment.get("value")
                 if name in self.sensors and segment.get("value"):
-                    cleaned_field = cleanup_field(self.sensors[name], segment.get("value"))
-                segments_dict[name]["value"].append(cleaned_field)
+                    cleaned_field = self.cleaners[name](segment.get("value"))
+                segments_dict[name].values.append(cleaned_field)
 
                 # Get the location of the merged segment from the crop
                 if segment.get("level") == "crop":
-                    segments_dict[name].update(dict(top=segment["top"], left=segment["left"], bottom=segment["bottom"], right=segment["right"]))
+                    segments_dict[name].location = dict(top=segment["top"], left=segment["left"], bottom=segment["bottom"], right=segment["right"])
             except Exception:
                 traceback.print_exc()
                 continue
         return segments_dict
 
-    def clean_segments(self, segments, monitorId, imageId):
+    def resize(self, max_monitors, ttl=None, history_size=None):
+        """
+        :param history_size: change the number of readings kept by history() (unchanged if None),
+            the windows of the monitors start over
+        """
+        self.monitors.resize(max_monitors, ttl)
+        if history_size is not None and history_size != self.history_size:
+            self.history_size = history_size
+            for mv in self.monitors.values():
+                mv.history_size = history_size
+                mv.histories.clear()
+
+    def close(self):
+        """
+        Nothing to release, the state is in process (see shard.ShardedCleaner)
+        """
+
+    def get_state(self, monitorIds=None):
+        """
+        The last valid values of the monitors (all of them by default) as arrays, least recently seen monitor first,
+        with wall clock times (so they can be restored in another process)
+        """
+        self.monitors.expire()
+        monitors = [
+            (monitorId, mv) for monitorId, mv in zip(self.monitors.keys(), self.monitors.values())
+            if monitorIds is None or monitorId in monitorIds
+        ]
+        slots = [mv.slot for _, mv in monitors]
+        values = self.store.values[slots]
+        has_value = np.array([[v is not None for v in row] for row in values], bool).reshape(values.shape)
+        return dict(
+            monitors=np.array([str(monitorId) for monitorId, _ in monitors], str),
+            sensors=np.array(list(self.store.sensor_index), str),
+            times=time.time() - (time.monotonic() - self.store.times[slots]),
+            values=np.where(has_value, values, '').astype(str),
+            has_value=has_value,
+        )
+
+    def pop_state(self, monitorIds):
+        """
+        Get the state of the monitors (see get_state) and forget them, to move them to another cleaner
+        """
+        state = self.get_state(set(monitorIds))
+        for monitorId in state['monitors']:
+            self.forget(str(monitorId))
+        return state
+
+    def set_state(self, state):
+        """
+        Restore the monitors values from a get_state dict (or npz file)
+        :return: the number of monitors restored
+        """
+        sensors = [(str(name), self.store.sensor(str(name))) for name in state['sensors']]
+        times = time.monotonic() - (time.time() - state['times'])
+        for monitorId, monitor_times, values, has_value in zip(state['monitors'], times, state['values'], state['has_value']):
+            mv = self.get_monitor(str(monitorId))
+            for (name, index), t, value, valid in zip(sensors, monitor_times, values, has_value):
+                if valid:
+                    self.store.times[mv.slot, index] = t
+                    mv.set_last_valid_value(name, index, str(value))
+        return len(state['monitors'])
+
+    def load_state(self, path):
+        """
+        Restore the monitors values from a snapshot written by save_state
+        :return: the number of monitors restored
+        """
+        with np.load(path, allow_pickle=False) as state:
+            return self.set_state(state)
+
+    def clean_batch(self, items):
+        """
+        Clean the segments of many frames
+        :param items: list of (monitorId, imageId, segments, timestamp)
+        """
+        return [self.clean_segments(segments, monitorId, imageId, timestamp) for monitorId, imageId, segments, timestamp in items]
+
+    def capture_time(self, timestamp):
+        """
+        The time.monotonic() seconds of a client timestamp (see parse_timestamp), None if it is missing, not finite
+        or more than MAX_CLOCK_SKEW seconds in the future: a frame from the future would make every later one late
+        """
+        t = parse_timestamp(timestamp)
+        if t is None or not math.isfinite(t):
+            return None
+        if t > time.time() + MAX_CLOCK_SKEW:
+            logging.debug(f'Ignoring timestamp {timestamp}, it is in the future')
+            return None
+        return t - self.clock_offset
+
+    def clean_segments(self, segments, monitorId, imageId, timestamp=None):
+        """
+        Clean the ocr segments of a frame, the input segments are not modified.
+        :param timestamp: the capture time of the frame (see parse_timestamp), if the client sent it
+        :return: a new list of segments, one per name, or None if the frame is older than the newest frame of the monitor
+        """
         try:
+            now = self.capture_time(timestamp)
+            # drop a late frame before doing any work, its values would override newer ones, and before refreshing
+            # the monitor in the cache
+            known = self.monitors.peek(monitorId) if monitorId is not None else None
+            if known is not None and known.is_late(imageId, now):
+                return None
+            mv: MonitorValues = self.get_monitor(monitorId)
+            mv.set_newest(imageId, now)
+            if now is None:
+                now = time.monotonic()
+
             segments_dict = self.basic_cleanup(segments)
 
             # Split systole-diastole
             self.sysdis(segments_dict)
 
-            if monitorId is None:
-                monitorId = "unkown monitor"
-            mv: MonitorValues = self.monitors[monitorId]
-
-            for name, aug_dict in segments_dict.items():
+            cleaned_segments = []
+            for name, segment in segments_dict.items():
+                value = segment.values
                 try:
                     if name in self.sensors and self.sensors[name].get("dtype") in [float, int]:
-                        res = mv.get_latest_valid_value(aug_dict)
+                        res = mv.get_latest_valid_value({"name": name, "value": segment.values}, now=now)
                         if res:
-                            segments_dict[name]["value"] = res
-                    if isinstance(segments_dict[name]["value"], list):
-                        if not segments_dict[name]["value"]:
-                            segments_dict[name]["value"] = None
+                            value = res
+                    if isinstance(value, list):
+                        if not value:
+                            value = None
                         else:
                             try:
-                                segments_dict[name]["value"] = Counter(segments_dict[name]["value"]).most_common(1)[0][0]
+                                value = Counter(value).most_common(1)[0][0]
                             except Exception:
-                                segments_dict[name]["value"] = segments_dict[name]["value"][0] if len(segments_dict[name]["value"]) > 0 else None
-                    if "clean_value" in segments_dict[name]:
-                        segments_dict[name].pop("clean_value")
+                                value = value[0] if len(value) > 0 else None
                 except Exception:
                     traceback.print_exc()
-                    continue
-            return [v for k, v in segments_dict.items()]
+                cleaned_segments.append(segment.to_dict(value))
+            return cleaned_segments
         except Exception:
             traceback.print_exc()
             return segments
+
+
+def save_state(path, state):
+    """
+    Write a Cleaner.get_state() snapshot, atomically replacing the previous one
+    """
+    tmp = f'{path}.tmp'
+    with open(tmp, 'wb') as f:
+        np.savez(f, **state)
+    os.replace(tmp, path)
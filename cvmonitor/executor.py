@@ -0,0 +1,120 @@
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from prometheus_client import REGISTRY, Counter, Gauge
+
+
+def exit_with_parent(parent):
+    """
+    Worker initializer: exit when the server process is gone, even if it could not shut down the pool
+    (e.g. it was killed), otherwise workers wait on their queue forever.
+    """
+    def watch():
+        while os.getppid() == parent:
+            time.sleep(1)
+        os._exit(0)
+    threading.Thread(target=watch, daemon=True).start()
+
+
+class Overloaded(Exception):
+    """
+    Raised when the executor queue is full
+    """
+
+
+class Executor:
+    """
+    Run cpu bound work (decoding, qr detection, warping, encoding) on a pool of worker processes.
+
+    The server runs on gevent, so waiting on a result from a request greenlet lets the loop serve other
+    requests in the meantime.
+    At most `workers + queue_size` calls may be in flight, more raise `Overloaded`.
+    With 0 workers everything runs inline, which is handy for debugging.
+    """
+
+    def __init__(self, workers, queue_size, registry=REGISTRY):
+        self.workers = workers
+        self.queue_size = queue_size
+        self.pool = None
+        self.pending = 0
+        self.lock = threading.Lock()
+
+        self.workers_gauge = Gauge('cvmonitor_pool_workers', 'Number of worker processes', registry=registry)
+        self.workers_gauge.set(workers)
+        self.busy_gauge = Gauge('cvmonitor_pool_busy', 'Number of busy worker processes', registry=registry)
+        self.busy_gauge.set_function(lambda: min(self.pending, self.workers))
+        self.queued_gauge = Gauge('cvmonitor_pool_queued', 'Number of calls waiting for a worker', registry=registry)
+        self.queued_gauge.set_function(lambda: max(self.pending - self.workers, 0))
+        self.rejected = Counter('cvmonitor_pool_rejected', 'Number of calls rejected since the queue was full', registry=registry)
+
+    def get_pool(self):
+        """
+        Get the process pool, (re)creating it if needed.
+        Workers are spawned rather than forked, so they don't inherit the gevent patched state of the server.
+        """
+        if self.pool is None:
+            self.pool = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=exit_with_parent,
+                initargs=(os.getpid(),),
+            )
+        return self.pool
+
+    def submit(self, fn, *args, **kwargs):
+        """
+        Schedule fn(*args, **kwargs) on a worker, returns a future.
+        """
+        if self.workers == 0:
+            future = Future()
+            try:
+                future.set_result(fn(*args, **kwargs))
+            except Exception as e:
+                future.set_exception(e)
+            return future
+
+        with self.lock:
+            if self.pending >= self.workers + self.queue_size:
+                self.rejected.inc()
+                raise Overloaded(f"Too many pending calls ({self.pending})")
+            self.pending += 1
+        try:
+            pool = self.get_pool()
+            try:
+                future = pool.submit(fn, *args, **kwargs)
+            except BrokenProcessPool:
+                self.close(pool)
+                pool = self.get_pool()
+                future = pool.submit(fn, *args, **kwargs)
+        except Exception:
+            self.done(None, None)
+            raise
+        future.add_done_callback(lambda f: self.done(f, pool))
+        return future
+
+    def done(self, future, pool):
+        with self.lock:
+            self.pending -= 1
+        if future is not None and not future.cancelled() and isinstance(future.exception(), BrokenProcessPool):
+            # A worker died (e.g. a crash in native code), start over with a new pool
+            self.close(pool)
+
+    def run(self, fn, *args, **kwargs):
+        """
+        Run fn(*args, **kwargs) on a worker and wait for the result.
+        """
+        return self.submit(fn, *args, **kwargs).result()
+
+    def close(self, pool=None):
+        """
+        Shut down the pool (only if it is still the given one), a new one is created on the next call
+        """
+        if pool is not None and pool is not self.pool:
+            return
+        pool, self.pool = self.pool, None
+        if pool is not None:
+            pool.shutdown(wait=False)
@@ -1,5 +1,7 @@
+import io
 import logging
 import math
+import struct
 
 import cv2
 import exifread
@@ -7,10 +9,18 @@ import imageio
 import numpy as np
 from pylab import imshow, show # noqa F401
 
-from .qr import find_qrcode
+from .qr import find_qrcode, find_qrcode_near, find_qrcode_scaled
+from .utils import JPEG_QUALITY, LRUCache, decode_gray, encode_image
 
 np.set_printoptions(precision=3)
 
+# qr corners that moved more than this part of the qr size since the previous frame mean the camera moved,
+# they are used as is instead of being smoothed
+ALIGN_RESET_FRACTION = 0.1
+
+# remap tables of the homographies that were reused, per worker process, keyed by monitor, homography and image shape
+REMAP_CACHE = LRUCache(16)
+
 
 def order_points(pts):
     """
@@ -51,12 +61,82 @@ def get_rotation_transform(height, width, angle):
 
     return rotation_mat
 
+def read_exif_orientation(data):
+    """
+    Read the exif orientation tag (0x0112) straight from the jpeg APP1 segment,
+    without parsing the other tags.
+    :param data: the encoded image, any bytes like object (e.g. a memoryview, which is not copied)
+    :return: the orientation value, or None if there is no exif orientation
+    :raises ValueError: if this is not a jpeg or it is malformed
+    """
+    try:
+        if data[0] != 0xFF or data[1] != 0xD8:
+            raise ValueError("Not a jpeg")
+        offset = 2
+        while True:
+            if data[offset] != 0xFF:
+                raise ValueError(f"Expected a marker at {offset}")
+            marker = data[offset + 1]
+            if marker == 0xFF:
+                # fill byte
+                offset += 1
+                continue
+            if marker in (0xDA, 0xD9):
+                # start of scan / end of image, no exif
+                return None
+            (length,) = struct.unpack_from(">H", data, offset + 2)
+            if marker == 0xE1 and bytes(data[offset + 4:offset + 10]) == b"Exif\0\0":
+                return read_tiff_orientation(data, offset + 10)
+            offset += 2 + length
+    except (IndexError, struct.error) as e:
+        raise ValueError(f"Malformed jpeg: {e}")
+
+
+def read_tiff_orientation(data, tiff):
+    """
+    Find the orientation tag in IFD0 of the tiff structure at offset tiff
+    """
+    byte_order = bytes(data[tiff:tiff + 2])
+    if byte_order == b"II":
+        endian = "<"
+    elif byte_order == b"MM":
+        endian = ">"
+    else:
+        raise ValueError("Bad tiff byte order")
+    (ifd0,) = struct.unpack_from(endian + "I", data, tiff + 4)
+    (entries,) = struct.unpack_from(endian + "H", data, tiff + ifd0)
+    for i in range(entries):
+        entry = tiff + ifd0 + 2 + i * 12
+        tag, dtype = struct.unpack_from(endian + "HH", data, entry)
+        if tag == 0x0112:
+            if dtype != 3:
+                raise ValueError("Orientation should be a short")
+            return struct.unpack_from(endian + "H", data, entry + 8)[0]
+    return None
+
+
+def read_exifread_orientation(im_file):
+    tags = exifread.process_file(im_file, details=False)
+    im_file.seek(0)
+    if isinstance(tags, dict) and 'Image Orientation' in tags:
+        return tags['Image Orientation'].values[0]
+    return None
+
+
 def get_exif_rotation(im_file):
     rotation = None
-    # Try with exif:
-    tags = exifread.process_file(im_file)
-    if isinstance(tags,dict) and 'Image Orientation' in tags:
-        orientation = tags['Image Orientation'].values[0]
+    # Try with exif, reading only the orientation from the header:
+    try:
+        if isinstance(im_file, io.BytesIO):
+            with im_file.getbuffer() as data:
+                orientation = read_exif_orientation(data)
+        else:
+            orientation = read_exif_orientation(im_file.read())
+            im_file.seek(0)
+    except ValueError:
+        im_file.seek(0)
+        orientation = read_exifread_orientation(im_file)
+    if orientation is not None:
         if orientation == 6:
             rotation = -90
         elif orientation == 8:
@@ -106,30 +186,115 @@ def rotate_image(image, rotation):
     return image
 
 
+def get_rotation_matrix(rotation, height, width):
+    """
+    The transform from the pixel coordinates of an image of the given size to those of the image rotated by
+    rotate_image, to compose with a homography rather than rotating the pixels
+    :return: the 3x3 matrix, and the (height, width) of the rotated image
+    """
+    if rotation == -90:
+        return np.array([[0, 1, 0], [-1, 0, width - 1], [0, 0, 1]], np.float64), (width, height)
+    if rotation == 90:
+        return np.array([[0, -1, height - 1], [1, 0, 0], [0, 0, 1]], np.float64), (width, height)
+    if rotation == 180:
+        return np.array([[-1, 0, width - 1], [0, -1, height - 1], [0, 0, 1]], np.float64), (height, width)
+    return np.eye(3), (height, width)
+
 
-def get_oriented_image(im_file, use_exif=True, use_qr=False, detected_qrcode=None, qrprefix=''):
+def same_side(image, polygon, other):
     """
-    Orient an image by it's exif data or by qr code that is expected to be on
-    the image top-left side.
-    :return: the rotated image, qrcode *in original cooordinates*, rotation in angles
+    Check that two qr polygons are on the same side of both image center lines, so they give the same rotation
+    """
+    height, width = image.shape[:2]
+    a, b = np.mean(polygon, 0), np.mean(other, 0)
+    return (a[0] > width // 2) == (b[0] > width // 2) and (a[1] > height // 2) == (b[1] > height // 2)
+
+
+def get_cached_qr_rotation(image, qr_hint, qrprefix=''):
+    """
+    Look for the qr code only around where it was in the previous frame of the same monitor.
+    :param qr_hint: dict with the `monitorId`, image `shape`, qr `polygon` and `rotation` of the previous frame
+    :return: rotation, qr code; the qr code is None if it is not there anymore
+    """
+    if tuple(qr_hint['shape']) != image.shape[:2]:
+        return None, None
+    detected_qrcode = find_qrcode_near(image, qr_hint['polygon'], qrprefix, qr_hint['monitorId'])
+    if detected_qrcode is None:
+        return None, None
+    if same_side(image, detected_qrcode.polygon, qr_hint['polygon']):
+        return qr_hint['rotation'], detected_qrcode
+    return get_qr_rotation(image, detected_qrcode, qrprefix)
+
+
+def get_orientation(im_file, use_exif=True, use_qr=False, qrprefix='', search_scale=1, qr_hint=None, find_qr=False, gray=False):
+    """
+    Decode an image and find its rotation, by it's exif data or by qr code that is expected to be on
+    the image top-left side. The qr code is searched on the luminance of the image.
+    :param search_scale: search for the qr code on the image decoded at 1/search_scale (2, 4 or 8)
+    :param qr_hint: where the qr code was in the previous frame (see get_cached_qr_rotation), tried first
+    :param find_qr: look for the qr code even if the exif has the rotation (to align by it)
+    :param gray: decode only the luminance of the image (see utils.decode_gray)
+    :return: the image as decoded, qrcode in its coordinates, rotation in angles
     """
 
     # try exif
     im_file, rotation  = get_exif_rotation(im_file)
+    exif_rotation = rotation if use_exif else None
 
-    image = imageio.imread(im_file)
+    if gray and isinstance(im_file, io.BytesIO):
+        with im_file.getbuffer() as data:
+            image = decode_gray(data)
+    elif gray:
+        image = decode_gray(im_file.read())
+        im_file.seek(0)
+    else:
+        image = np.asarray(imageio.imread(im_file))
 
     # if no oritenation in exif or don't use exif, maybe try qr code:
     detected_qrcode = None
-    if rotation is None and use_qr or not use_exif:
-        rotation, detected_qrcode = get_qr_rotation(image, detected_qrcode, qrprefix)
+    if exif_rotation is None and use_qr or not use_exif or find_qr:
+        # convert once for all the qr searches
+        luminance = image if image.ndim == 2 else cv2.cvtColor(image, cv2.COLOR_RGB2GRAY)
+        if qr_hint is not None:
+            rotation, detected_qrcode = get_cached_qr_rotation(luminance, qr_hint, qrprefix)
+        if detected_qrcode is None:
+            if search_scale > 1:
+                im_file.seek(0)
+                detected_qrcode = find_qrcode_scaled(im_file.read(), luminance, qrprefix, search_scale)
+            rotation, detected_qrcode = get_qr_rotation(luminance, detected_qrcode, qrprefix)
+        if exif_rotation is not None:
+            rotation = exif_rotation
+    return image, detected_qrcode, rotation
 
+
+def get_oriented_image(im_file, use_exif=True, use_qr=False, detected_qrcode=None, qrprefix='', search_scale=1, qr_hint=None):
+    """
+    Orient an image by it's exif data or by qr code (see get_orientation)
+    :return: the rotated image, qrcode *in original cooordinates*, rotation in angles
+    """
+    image, detected_qrcode, rotation = get_orientation(im_file, use_exif, use_qr, qrprefix, search_scale, qr_hint)
     image = rotate_image(image, rotation)
 
     # don't waste the qr code detection
     return image, detected_qrcode, rotation
 
 
+def get_qr_homography(height, width, src_pts, qrsize=100, boundery=50.0):
+    """
+    The perspective transform mapping the (ordered) qr corners to a qrsize square at (boundery, boundery),
+    and the size of the canvas that holds the whole transformed image
+    """
+    tgt_pts = np.array([[boundery,boundery],[qrsize+boundery,boundery],[qrsize+boundery,qrsize+boundery],[boundery,qrsize+boundery]],np.float32)
+    shape_pts = np.array([[0,0],[width,0],[width,height],[0.0,height]],np.float32)
+    M = cv2.getPerspectiveTransform(src_pts, tgt_pts)
+    res = M @ np.concatenate([shape_pts,np.ones((4,1))],1).transpose()
+    for r in range(4):
+        res[:,r]/=res[-1,r]
+    width = int(np.ceil(max(res[0,:]))) #+ int(np.floor(min(res[0,:])))
+    height = int(np.ceil(max(res[1,:]))) #+ int(np.floor(min(res[1,:])))
+    return M, (width, height)
+
+
 def align_by_qrcode(image : np.ndarray, detected_qrcode, qrsize=100, boundery = 50.0, qrprefix=''):
     """
     Aling image by qrcode, normalize by qrcode size.
@@ -140,24 +305,246 @@ def align_by_qrcode(image : np.ndarray, detected_qrcode, qrsize=100, boundery =
 
 
     src_pts= np.array([(p.x,p.y) for p in detected_qrcode.polygon],np.float32)
-    width = image.shape[1]
-    height = image.shape[0]
-
-
     src_pts=order_points(src_pts).astype(np.float32)
-    
-    tgt_pts = np.array([[boundery,boundery],[qrsize+boundery,boundery],[qrsize+boundery,qrsize+boundery],[boundery,qrsize+boundery]],np.float32)
-    shape_pts = np.array([[0,0],[width,0],[width,height],[0.0,height]],np.float32)
-    M = cv2.getPerspectiveTransform(src_pts, tgt_pts)
-    res = M @ np.concatenate([shape_pts,np.ones((4,1))],1).transpose()
-    for r in range(4):
-        res[:,r]/=res[-1,r]
-    width = int(np.ceil(max(res[0,:]))) #+ int(np.floor(min(res[0,:])))
-    height = int(np.ceil(max(res[1,:]))) #+ int(np.floor(min(res[1,:])))
-    warped = cv2.warpPerspective(image, M,(width,height))
+    M, size = get_qr_homography(image.shape[0], image.shape[1], src_pts, qrsize, boundery)
+    warped = cv2.warpPerspective(image, M, size)
     return warped, M
 
 
+def smooth_corners(corners, previous, tolerance=1.0, smoothing=0.5):
+    """
+    Smooth the jitter of the qr corners of a fixed camera across frames.
+    :param previous: the (smoothed) corners of the previous frame, or None
+    :param tolerance: corners that moved at most this many pixels keep the previous ones
+    :param smoothing: weight of the new corners in the exponential moving average (1 means no smoothing)
+    :return: the corners to use, and whether they are the previous ones
+    """
+    if previous is None:
+        return corners, False
+    previous = np.asarray(previous, np.float32)
+    moved = np.abs(corners - previous).max()
+    if moved <= tolerance:
+        return previous, True
+    if moved > np.linalg.norm(corners[1] - corners[0]) * ALIGN_RESET_FRACTION:
+        return corners, False
+    return (previous + smoothing * (corners - previous)).astype(np.float32), False
+
+
+def get_warp_maps(M, size):
+    """
+    Fixed point remap tables equivalent to cv2.warpPerspective(image, M, size)
+    """
+    width, height = size
+    xs, ys = np.meshgrid(np.arange(width, dtype=np.float32), np.arange(height, dtype=np.float32))
+    points = np.stack([xs, ys], -1).reshape(-1, 1, 2)
+    src = cv2.perspectiveTransform(points, np.linalg.inv(M)).reshape(height, width, 2)
+    return cv2.convertMaps(src, None, cv2.CV_16SC2)
+
+
+def scale_homography(M, size, max_dim=None):
+    """
+    Fold a downscale into a homography, so the warp itself outputs an image of at most max_dim pixels on each side
+    :return: the scaled M and canvas size, the same ones if the canvas is small enough already
+    """
+    if max_dim is None or max(size) <= max_dim:
+        return M, size
+    scale = max_dim / max(size)
+    size = (max(int(round(size[0] * scale)), 1), max(int(round(size[1] * scale)), 1))
+    return np.diag([scale, scale, 1.0]) @ M, size
+
+
+def get_smoothed_homography(shape, detected_qrcode, qrsize=100, boundery=50.0, previous=None, tolerance=1.0, smoothing=0.5,
+                            rotation=None):
+    """
+    The homography aligning an image of the given shape by its qr code, smoothed with the one of the previous frame
+    (see smooth_corners and align_by_qrcode_smoothed)
+    :param rotation: the rotation of the image (see rotate_image), composed into the homography so the image itself
+        is not rotated
+    :return: the homography dict, and whether it is the previous one
+    """
+    R, (height, width) = get_rotation_matrix(rotation, *shape[:2])
+    polygon = np.array([(p.x, p.y) for p in detected_qrcode.polygon], np.float64)
+    # the qr corners in the coordinates of the rotated image
+    polygon = polygon @ R[:2, :2].T + R[:2, 2]
+    corners = order_points(polygon.astype(np.float32)).astype(np.float32)
+    version = previous['version'] + 1 if previous is not None else 0
+    if previous is not None and (previous['shape'], previous.get('rotation'), previous['qrsize'], previous['boundery']) != (
+        (height, width), rotation, qrsize, boundery
+    ):
+        previous = None
+    corners, reused = smooth_corners(corners, previous and previous['corners'], tolerance, smoothing)
+    if reused:
+        return previous, True
+    M, size = get_qr_homography(height, width, corners, qrsize, boundery)
+    return {
+        'corners': corners.tolist(),
+        'M': (M @ R).tolist(),
+        'size': size,
+        'version': version,
+        'shape': (height, width),
+        'rotation': rotation,
+        'qrsize': qrsize,
+        'boundery': boundery,
+    }, False
+
+
+def align_by_qrcode_smoothed(image, detected_qrcode, monitor_id, qrsize=100, boundery=50.0, previous=None,
+                             tolerance=1.0, smoothing=0.5, max_dim=None, rotation=None):
+    """
+    Align the image by its qr code like align_by_qrcode, smoothing the homography across the frames of a monitor.
+    When the homography of the previous frame is reused, warp with remap tables that are built once for it.
+    :param previous: the homography of the previous frame of the same monitor (or None)
+    :param max_dim: downscale the aligned image, in the same warp, to at most this many pixels on each side
+    :param rotation: the rotation of the (not rotated) image, done by the same warp
+    :return: the aligned image, and its homography: dict with the smoothed qr `corners` (of the rotated image),
+        `M` from the image as is, canvas `size` (at full scale) and a `version` that changes whenever M does
+    """
+    homography, reused = get_smoothed_homography(image.shape, detected_qrcode, qrsize, boundery, previous, tolerance, smoothing, rotation)
+    M = np.asarray(homography['M'])
+    if reused:
+        # keyed by M itself, the versions of homographies that started over without a previous one are not unique
+        key = (monitor_id, M.tobytes(), image.shape, max_dim)
+        maps = REMAP_CACHE.get(key)
+        if maps is None:
+            maps = get_warp_maps(*scale_homography(M, homography['size'], max_dim))
+            REMAP_CACHE.set(key, maps)
+        return cv2.remap(image, maps[0], maps[1], cv2.INTER_LINEAR), homography
+    return cv2.warpPerspective(image, *scale_homography(M, homography['size'], max_dim)), homography
+
+
+def orient_frame(data, use_exif=True, use_qr=False, qrprefix='', search_scale=1, qr_hint=None, align=False, gray=False):
+    """
+    Decode and orient an encoded frame (see get_oriented_image)
+    :param align: the frame is to be aligned by its qr code: look for it even if the exif has the rotation, and
+        don't rotate the image, the rotation is done by the alignment warp (see get_smoothed_homography)
+    :param gray: decode only the luminance of the frame
+    :return: the image (oriented unless align), the qr code in the coordinates of the image as decoded,
+        and the `qr` of align_frame (or None if there is no qr code)
+    """
+    image, detected_qrcode, rotation = get_orientation(
+        io.BytesIO(data), use_exif=use_exif, use_qr=use_qr, qrprefix=qrprefix, search_scale=search_scale,
+        qr_hint=qr_hint, find_qr=align, gray=gray,
+    )
+    qr = None if detected_qrcode is None else {
+        'monitorId': detected_qrcode.data.decode(),
+        'shape': image.shape[:2],
+        'polygon': [(p.x, p.y) for p in detected_qrcode.polygon],
+        'rotation': rotation,
+    }
+    if not align:
+        image = rotate_image(image, rotation)
+    return image, detected_qrcode, qr
+
+
+def align_frame(data, use_exif=True, use_qr=False, qrprefix='', qrsize=100, boundery=50.0, align=False, search_scale=1,
+                qr_hint=None, align_tolerance=1.0, align_smoothing=0.5, remap_cache_size=16, image_format='.jpg',
+                quality=JPEG_QUALITY, max_dim=None, gray=False):
+    """
+    Orient a single encoded frame, and align it by its qr code if asked to.
+    The alignment rotates the image in the same warp, so the pixels are resampled only once.
+    This runs in worker processes, so it only takes and returns picklable values.
+    :param qr_hint: the `qr` of the previous frame of the same monitor, to look for the qr code around it first
+        and to smooth the alignment with its `homography` (see align_by_qrcode_smoothed)
+    :param image_format: the format of the output image ('.jpg', '.png' or '.webp'), of the given jpeg/webp `quality`
+    :param max_dim: downscale the output image to at most this many pixels on each side (by the warp when aligning)
+    :param gray: output a grayscale image (only the luminance is decoded, so the warp has a third of the pixels to move)
+    :return: dict with the encoded `image` (see utils.encode_image), the `monitorId` in the qr code (or None),
+        the qr search stage that found the code (`qr_stage`, or None, 'cached' if found by the hint)
+        and the `qr` to pass as qr_hint for the next frame (or None)
+    """
+    image, detected_qrcode, qr = orient_frame(data, use_exif, use_qr, qrprefix, search_scale, qr_hint, align, gray)
+    monitor_id = qr and qr['monitorId']
+    if detected_qrcode is None and align:
+        raise ValueError("Could not align the image by qr code, no such code detected")
+    if align:
+        REMAP_CACHE.resize(remap_cache_size)
+        previous = qr_hint.get('homography') if qr_hint is not None and qr_hint['monitorId'] == monitor_id else None
+        image, qr['homography'] = align_by_qrcode_smoothed(
+            image, detected_qrcode, monitor_id, qrsize, boundery, previous, align_tolerance, align_smoothing, max_dim,
+            qr['rotation'],
+        )
+    elif max_dim is not None and max(image.shape[:2]) > max_dim:
+        scale = max_dim / max(image.shape[:2])
+        size = (max(int(round(image.shape[1] * scale)), 1), max(int(round(image.shape[0] * scale)), 1))
+        image = cv2.resize(image, size, interpolation=cv2.INTER_AREA)
+    return {
+        'image': encode_image(image, image_format, quality),
+        'monitorId': monitor_id,
+        'qr_stage': getattr(detected_qrcode, 'stage', None),
+        'qr': qr,
+    }
+
+
+def get_segment_boxes(segments, size, max_pixels=None):
+    """
+    The boxes of segments (with left, top, right and bottom in aligned coordinates), clipped to the aligned canvas size,
+    raises ValueError if a segment has no box or is outside the canvas, or if the boxes have more than max_pixels
+    :return: list of (left, top, right, bottom) ints
+    """
+    width, height = size
+    boxes = []
+    for i, segment in enumerate(segments):
+        if not isinstance(segment, dict):
+            raise ValueError(f"Segment {i} should be an object")
+        try:
+            left, top = int(math.floor(float(segment['left']))), int(math.floor(float(segment['top'])))
+            right, bottom = int(math.ceil(float(segment['right']))), int(math.ceil(float(segment['bottom'])))
+        except (KeyError, TypeError, ValueError):
+            raise ValueError(f"Segment {segment.get('name')} should have a left, top, right and bottom")
+        left, top, right, bottom = max(left, 0), max(top, 0), min(right, width), min(bottom, height)
+        if right <= left or bottom <= top:
+            raise ValueError(f"Segment {segment.get('name')} is outside the aligned image")
+        boxes.append((left, top, right, bottom))
+    pixels = sum((right - left) * (bottom - top) for left, top, right, bottom in boxes)
+    if max_pixels is not None and pixels > max_pixels:
+        raise ValueError(f"The segments have too many pixels ({pixels} > {max_pixels})")
+    return boxes
+
+
+def warp_segment(image, M, box):
+    """
+    Resample only a box of the image aligned by M, rather than the whole aligned image
+    """
+    left, top, right, bottom = box
+    shift = np.array([[1, 0, -left], [0, 1, -top], [0, 0, 1]], np.float64)
+    return cv2.warpPerspective(image, shift @ M, (right - left, bottom - top))
+
+
+def align_segments(data, segments, use_exif=True, use_qr=False, qrprefix='', qrsize=100, boundery=50.0, search_scale=1,
+                   qr_hint=None, align_tolerance=1.0, align_smoothing=0.5, image_format='.jpg', quality=JPEG_QUALITY, gray=False,
+                   max_pixels=None):
+    """
+    Align a frame by its qr code like align_frame, but only warp the boxes of the segments, in aligned coordinates.
+    :param segments: list of dicts with a `name`, `left`, `top`, `right` and `bottom`
+    :param max_pixels: the maximal total area of the tiles (see get_segment_boxes)
+    :return: dict with the encoded `tiles` (see utils.encode_image), the `segments` boxes of the tiles (clipped to
+        the aligned image), and the `monitorId`, `qr_stage` and `qr` of align_frame
+    """
+    image, detected_qrcode, qr = orient_frame(data, use_exif, use_qr, qrprefix, search_scale, qr_hint, align=True, gray=gray)
+    if detected_qrcode is None:
+        raise ValueError("Could not align the image by qr code, no such code detected")
+    monitor_id = qr['monitorId']
+    previous = qr_hint.get('homography') if qr_hint is not None and qr_hint['monitorId'] == monitor_id else None
+    qr['homography'], _ = get_smoothed_homography(
+        image.shape, detected_qrcode, qrsize, boundery, previous, align_tolerance, align_smoothing, qr['rotation']
+    )
+    M = np.asarray(qr['homography']['M'])
+    boxes = get_segment_boxes(segments, qr['homography']['size'], max_pixels)
+    tiles = []
+    for box in boxes:
+        tiles.append(encode_image(warp_segment(image, M, box), image_format, quality))
+    return {
+        'tiles': tiles,
+        'segments': [
+            {'name': segment.get('name'), 'left': left, 'top': top, 'right': right, 'bottom': bottom}
+            for segment, (left, top, right, bottom) in zip(segments, boxes)
+        ],
+        'monitorId': monitor_id,
+        'qr_stage': getattr(detected_qrcode, 'stage', None),
+        'qr': qr,
+    }
+
+
 def align_by_4_corners(image, corners, new_image_size=(1280, 768), margin_percent=10):
     """
     warp an image so the screen is aligned, and then crop the screen (with desired margin), and resize it to a desired size
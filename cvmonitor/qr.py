@@ -1,4 +1,6 @@
-import os
+import logging
+import time
+from collections import namedtuple
 from uuid import uuid4
 
 import cv2
@@ -8,15 +10,38 @@ import qrcode
 from matplotlib.backends.backend_pdf import PdfPages
 from pylab import imshow, show # noqa F401
 from pyzbar import pyzbar
+from pyzbar.locations import Point, Rect
+from pyzbar.pyzbar import Decoded
+
+from .utils import decode_gray
 
 np.set_printoptions(precision=3)
 
+# Coarse to fine qr search stages: name, region, downscale, use CLAHE, time budget in seconds.
+# Stages without a budget always run, so the search is never worse than a full frame search.
+QR_SEARCH_STAGES = [
+    ('quadrant-coarse', 'quadrant', 2, False, 0.02),
+    ('quadrant', 'quadrant', 1, False, 0.05),
+    ('frame-coarse', 'frame', 2, False, 0.05),
+    ('frame', 'frame', 1, False, None),
+    ('quadrant-clahe', 'quadrant', 1, True, 0.1),
+    ('frame-clahe', 'frame', 1, True, None),
+]
+# Part of the height/width searched by the quadrant stages
+QUADRANT_SIZE = 0.6
+
+# A pyzbar detection, with the search stage that found it
+QRCode = namedtuple('QRCode', Decoded._fields + ('stage',))
+
+# Flags for decoding a jpeg directly at a reduced scale (libjpeg scales in the DCT domain)
+REDUCED_GRAYSCALE = {
+    2: cv2.IMREAD_REDUCED_GRAYSCALE_2,
+    4: cv2.IMREAD_REDUCED_GRAYSCALE_4,
+    8: cv2.IMREAD_REDUCED_GRAYSCALE_8,
+}
 
-def generate_pdf(pdf_file, title, ncols, nrows):
-    if not nrows:
-        nrows = int(os.environ.get("CVMONITOR_QR_PDF_ROWS", 6))
-    if not ncols:
-        ncols = int(os.environ.get("CVMONITOR_QR_PDF_COLS", 4))
+
+def generate_pdf(pdf_file, title, ncols=4, nrows=6):
     with PdfPages(pdf_file) as pdf:
         index = 0
         fig, axarr = plt.subplots(nrows, ncols, figsize=[8, 11])
@@ -63,20 +88,124 @@ def read_codes(image):
     return codes
 
 
-def find_qrcode(image, prefix):
-    if len(image.shape) == 3:
-        image = cv2.cvtColor(image, cv2.COLOR_RGB2GRAY)
+def read_codes_from(data):
+    """
+    Decode the luminance of an encoded image and read the barcodes in it
+    """
+    return read_codes(decode_gray(data))
 
-    decodedObjects = pyzbar.decode(image)
-    if not decodedObjects:
-        clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(64, 64))
-        image = clahe.apply(image)
-        decodedObjects = pyzbar.decode(image)
 
-    detected_qrcode = None
-    for obj in decodedObjects:
+def decode_qrcode(image, prefix, stage=None):
+    """
+    Decode a grayscale image, return the first code that starts with prefix (or None)
+    """
+    for obj in pyzbar.decode(image):
         text = obj.data.decode()
         if text.startswith(prefix):
-            detected_qrcode = obj
-            break
-    return detected_qrcode
+            return QRCode(*obj, stage=stage)
+    return None
+
+
+def move_qrcode(detected_qrcode, left=0, top=0, scale=1):
+    """
+    Map a qr code from a (scaled) window back to the coordinates of the whole image
+    """
+    rect = detected_qrcode.rect
+    return detected_qrcode._replace(
+        rect=Rect(rect.left * scale + left, rect.top * scale + top, rect.width * scale, rect.height * scale),
+        polygon=[Point(p.x * scale + left, p.y * scale + top) for p in detected_qrcode.polygon],
+    )
+
+
+def refine_qrcode(image, detected_qrcode, scale, prefix):
+    """
+    Refine a qr code found at 1/scale on a full resolution window around it, padded by half the code size.
+    Returns the scaled up code if it can't be refined.
+    """
+    rect = detected_qrcode.rect
+    pad = max(rect.width, rect.height) * scale // 2 + scale
+    top = max(rect.top * scale - pad, 0)
+    left = max(rect.left * scale - pad, 0)
+    bottom = min((rect.top + rect.height) * scale + pad, image.shape[0])
+    right = min((rect.left + rect.width) * scale + pad, image.shape[1])
+    refined = decode_qrcode(image[top:bottom, left:right], prefix, detected_qrcode.stage)
+    if refined is not None and refined.data == detected_qrcode.data:
+        return move_qrcode(refined, left, top)
+    return move_qrcode(detected_qrcode, scale=scale)
+
+
+def find_qrcode_near(image, polygon, prefix, data=None, stage='cached'):
+    """
+    Search for the qr code only in a window around polygon (e.g. where it was in the previous frame),
+    padded by the code size to allow for some camera movement.
+    :param data: if given, only accept a code with this data
+    :return: the qr code in image coordinates, or None
+    """
+    if len(image.shape) == 3:
+        image = cv2.cvtColor(image, cv2.COLOR_RGB2GRAY)
+    points = np.asarray(polygon)
+    low, high = points.min(0), points.max(0)
+    pad = int(max(high - low)) + 1
+    left, top = (max(int(v) - pad, 0) for v in low)
+    right, bottom = int(high[0]) + pad, int(high[1]) + pad
+    detected_qrcode = decode_qrcode(image[top:bottom, left:right], prefix, stage)
+    if detected_qrcode is None or (data is not None and detected_qrcode.data.decode() != data):
+        return None
+    return move_qrcode(detected_qrcode, left, top)
+
+
+def find_qrcode(image, prefix, stages=QR_SEARCH_STAGES):
+    """
+    Find a qr code starting with prefix, coarse to fine: first on a downscaled image of the top-left quadrant,
+    where the code is expected to be, then widening the search (and trying CLAHE) only on failure.
+    A stage with a budget is skipped if the search already took longer than the budgets up to and including it.
+    :return: the qr code, its `stage` field is the name of the stage that found it
+    """
+    if len(image.shape) == 3:
+        image = cv2.cvtColor(image, cv2.COLOR_RGB2GRAY)
+
+    start = time.monotonic()
+    allowed = 0.0
+    for name, region, scale, clahe, budget in stages:
+        elapsed = time.monotonic() - start
+        if budget is not None:
+            allowed += budget
+            if elapsed > allowed:
+                logging.debug(f'qr search: skipping {name}, {elapsed:.3f}s over the {allowed:.3f}s budget')
+                continue
+        roi = image
+        if region == 'quadrant':
+            roi = image[:int(image.shape[0] * QUADRANT_SIZE), :int(image.shape[1] * QUADRANT_SIZE)]
+        if scale > 1:
+            roi = cv2.resize(roi, (roi.shape[1] // scale, roi.shape[0] // scale), interpolation=cv2.INTER_AREA)
+        if clahe:
+            grid = 64 if region == 'frame' else int(64 * QUADRANT_SIZE)
+            roi = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(grid, grid)).apply(roi)
+        detected_qrcode = decode_qrcode(roi, prefix, name)
+        if detected_qrcode is not None:
+            if scale > 1:
+                detected_qrcode = refine_qrcode(image, detected_qrcode, scale, prefix)
+            logging.debug(f'qr search: found by {name} in {time.monotonic() - start:.3f}s')
+            return detected_qrcode
+    return None
+
+
+def find_qrcode_scaled(data, image, prefix, scale):
+    """
+    Find the qr code on a 1/scale version of the image, decoded directly at that scale,
+    then refine its polygon on a small full resolution window around it.
+    Falls back to a full resolution search if the code is not found at the reduced scale.
+    :param data: the encoded image
+    :param image: the full resolution decoded image
+    :return: the qr code *in full resolution coordinates*
+    """
+    if scale not in REDUCED_GRAYSCALE:
+        return find_qrcode(image, prefix)
+    # Don't let opencv apply the exif orientation, so coordinates match the (unrotated) full image.
+    reduced = cv2.imdecode(np.frombuffer(data, np.uint8), REDUCED_GRAYSCALE[scale] | cv2.IMREAD_IGNORE_ORIENTATION)
+    detected_qrcode = find_qrcode(reduced, prefix) if reduced is not None else None
+    if detected_qrcode is None:
+        return find_qrcode(image, prefix)
+    if len(image.shape) == 3:
+        image = cv2.cvtColor(image, cv2.COLOR_RGB2GRAY)
+    return refine_qrcode(image, detected_qrcode, scale, prefix)
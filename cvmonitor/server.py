@@ -5,7 +5,10 @@ import exifread
 from prometheus_flask_exporter import PrometheusMetrics
 from flasgger import Swagger
 from .cv import ComputerVision
-import os
+from .config import Settings
+import atexit
+import gevent
+import signal
 from gevent.pywsgi import WSGIServer
 from flask import Flask
 import logging
@@ -13,13 +16,15 @@ import logging
 
 class Server:
 
-    def __init__(self, log_level=logging.DEBUG):
+    def __init__(self, settings=None):
+        self.settings = settings or Settings.from_env()
         self.app = Flask(__name__)
-        self.app.logger.setLevel(log_level)
+        self.app.logger.setLevel(self.settings.log_level)
         self.cors = CORS(self.app, resources={r"/*": {"origins": "*"}})
         self.metrics = PrometheusMetrics(self.app)
         self.metrics.info('app_info', 'Version info', version=__version__)
-        self.cv = ComputerVision()
+        self.cv = ComputerVision(self.settings, self.metrics.registry)
+        atexit.register(self.cv.close)
         self.app.register_blueprint(self.cv.blueprint, url_prefix='/v1/')
         self.app.config['SWAGGER'] = {
             'title': 'Corona Medical Monitors Camera Monitoring API',
@@ -38,16 +43,32 @@ class Server:
             """
             return 'pong'
 
+    def reload(self):
+        """
+        Reload the settings from the environment.
+        Requests in flight keep the settings they started with, bad settings are logged and ignored.
+        The number of workers and the host/port are only read at startup.
+        """
+        try:
+            settings = Settings.from_env()
+        except ValueError as e:
+            logging.error(f'Not reloading settings: {e}')
+            return
+        self.settings = settings
+        self.cv.settings = settings
+        self.app.logger.setLevel(settings.log_level)
+        logging.getLogger().setLevel(settings.log_level)
+        logging.info(f'Reloaded settings: {settings}')
 
-def init_logs():
-    log_level_name = os.environ.get('CVMONITOR_LOG_LEVEL', 'DEBUG')
-    log_level = logging.DEBUG
-    if (log_level_name == 'INFO'):
-        log_level = logging.INFO
-    if (log_level_name == 'WARNING'):
-        log_level = logging.WARNING
-    if (log_level_name == 'ERROR'):
-        log_level = logging.ERROR
+    def handle_reload_signal(self):
+        """
+        Reload the settings on SIGHUP
+        """
+        gevent.signal_handler(signal.SIGHUP, self.reload)
+
+
+def init_logs(settings):
+    log_level = getattr(logging, settings.log_level)
 
     for logger in (
 
@@ -63,9 +84,11 @@ def init_logs():
 
 
 def main():
-    log_level = init_logs()
-    server = Server(log_level)
-    host = os.environ.get('CVMONITOR_HOST', '0.0.0.0')
-    port = int(os.environ.get('CVMONITOR_PORT', '8088'))
+    settings = Settings.from_env()
+    init_logs(settings)
+    server = Server(settings)
+    server.handle_reload_signal()
+    host = settings.host
+    port = settings.port
     logging.info(f'serving on http://{host}:{port}/apidocs')
     WSGIServer((host, port), server.app).serve_forever()
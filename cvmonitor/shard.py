@@ -0,0 +1,374 @@
+"""
+Sharded ocr cleaning: the per monitor state is partitioned over worker processes by a consistent hash of the monitorId,
+so every monitor is always cleaned by the same process and cleaning scales over cores.
+"""
+import bisect
+import hashlib
+import logging
+import multiprocessing
+import os
+import threading
+
+import gevent.monkey
+import gevent.socket
+import numpy as np
+from prometheus_client import REGISTRY, CollectorRegistry, Counter
+
+from .device_fields import Cleaner, get_fields_info
+from .executor import exit_with_parent
+
+
+def stable_hash(key):
+    """
+    A hash of a string that is the same in every process (unlike hash())
+    """
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), 'big')
+
+
+class HashRing:
+    """
+    Consistent hashing of keys to nodes: adding or removing a node only moves the keys of that node.
+    Every node has `replicas` points on the ring, to spread the keys evenly.
+    """
+
+    def __init__(self, nodes=(), replicas=64):
+        self.replicas = replicas
+        self.points = []
+        self.owners = []
+        for node in nodes:
+            self.add(node)
+
+    def add(self, node):
+        for i in range(self.replicas):
+            point = stable_hash(f'{node}:{i}')
+            index = bisect.bisect(self.points, point)
+            self.points.insert(index, point)
+            self.owners.insert(index, node)
+
+    def remove(self, node):
+        kept = [(p, o) for p, o in zip(self.points, self.owners) if o != node]
+        self.points = [p for p, _ in kept]
+        self.owners = [o for _, o in kept]
+
+    def nodes(self):
+        return sorted(set(self.owners))
+
+    def node(self, key):
+        index = bisect.bisect(self.points, stable_hash(str(key))) % len(self.points)
+        return self.owners[index]
+
+
+def select_state(state, mask):
+    """
+    The monitors of a Cleaner.get_state() dict that are in the mask
+    """
+    return dict(
+        monitors=state['monitors'][mask],
+        sensors=state['sensors'],
+        times=state['times'][mask],
+        values=state['values'][mask],
+        has_value=state['has_value'][mask],
+    )
+
+
+def merge_states(states):
+    """
+    Concatenate Cleaner.get_state() dicts, that may have different sensors
+    """
+    sensors = list(dict.fromkeys(str(name) for state in states for name in state['sensors']))
+    columns = {name: i for i, name in enumerate(sensors)}
+    count = sum(len(state['monitors']) for state in states)
+    times = np.full((count, len(sensors)), -np.inf)
+    values = np.full((count, len(sensors)), '', dtype=object)
+    has_value = np.zeros((count, len(sensors)), bool)
+    row = 0
+    for state in states:
+        rows = slice(row, row + len(state['monitors']))
+        index = [columns[str(name)] for name in state['sensors']]
+        times[rows, index] = state['times']
+        values[rows, index] = state['values']
+        has_value[rows, index] = state['has_value']
+        row = rows.stop
+    return dict(
+        monitors=np.concatenate([state['monitors'] for state in states] + [np.array([], str)]),
+        sensors=np.array(sensors, str),
+        times=times,
+        values=values.astype(str),
+        has_value=has_value,
+    )
+
+
+def overlap_totals(cleaner):
+    return {
+        sample.labels['sensor']: sample.value
+        for metric in cleaner.overlaps.collect() for sample in metric.samples if sample.name.endswith('_total')
+    }
+
+
+class ShardError(RuntimeError):
+    """
+    A request to a cleaner shard failed
+    """
+
+
+def rebalance_shard(cleaner, shard, nodes):
+    ring = HashRing(nodes)
+    return cleaner.pop_state([m for m in cleaner.monitors.keys() if ring.node(m) != shard])
+
+
+# The requests a shard answers: op -> fn(cleaner, shard, args)
+SHARD_OPS = {
+    'clean': lambda cleaner, shard, items: cleaner.clean_batch(items),
+    'rebalance': rebalance_shard,
+    'export': lambda cleaner, shard, _: cleaner.pop_state(cleaner.monitors.keys()),
+    'get_state': lambda cleaner, shard, _: cleaner.get_state(),
+    'set_state': lambda cleaner, shard, state: cleaner.set_state(state),
+    'history': lambda cleaner, shard, args: cleaner.history(*args),
+    'forget': lambda cleaner, shard, monitorId: cleaner.forget(monitorId),
+    'resize': lambda cleaner, shard, args: cleaner.resize(*args),
+    'stats': lambda cleaner, shard, _: (cleaner.count_monitors(), cleaner.monitors_nbytes()),
+}
+
+
+def serve_shard(conn, parent, shard, max_monitors, ttl, history_size):
+    """
+    A shard process: own a Cleaner and answer the requests of the ShardedCleaner over conn
+    """
+    exit_with_parent(parent)
+    cleaner = Cleaner(get_fields_info(), max_monitors, ttl, registry=CollectorRegistry(), history_size=history_size)
+    while True:
+        op, args = conn.recv()
+        if op == 'stop':
+            return
+        try:
+            if op not in SHARD_OPS:
+                raise ValueError(f'Unknown shard request {op}')
+            conn.send((SHARD_OPS[op](cleaner, shard, args), overlap_totals(cleaner), None))
+        except Exception as e:
+            logging.exception(f'Shard {shard} failed on {op}')
+            conn.send((None, overlap_totals(cleaner), f'{type(e).__name__}: {e}'))
+
+
+class Shard:
+    """
+    The front end of a shard process
+    """
+
+    def __init__(self, shard, max_monitors, ttl, history_size=0):
+        self.shard = shard
+        self.conn, child = multiprocessing.Pipe()
+        self.process = multiprocessing.get_context('spawn').Process(
+            target=serve_shard, args=(child, os.getpid(), shard, max_monitors, ttl, history_size), name=f'cleaner-shard-{shard}', daemon=True
+        )
+        self.process.start()
+        child.close()
+        self.lock = threading.Lock()
+        self.overlaps = {}
+
+    def send(self, op, args=None):
+        self.conn.send((op, args))
+
+    def recv(self):
+        if gevent.monkey.is_module_patched('socket'):
+            # don't block the gevent loop while the shard works
+            gevent.socket.wait_read(self.conn.fileno())
+        return self.conn.recv()
+
+    def stop(self):
+        with self.lock:
+            try:
+                self.send('stop')
+            except OSError:
+                pass
+        self.process.join(5)
+        if self.process.is_alive():
+            self.process.kill()
+        self.conn.close()
+
+
+class ShardedCleaner:
+    """
+    A Cleaner whose monitors are partitioned over `shards` worker processes by a consistent hash of the monitorId.
+    Each shard keeps at most max_monitors / shards monitors. Changing the number of shards (resize_shards) moves
+    only the monitors of the added or removed shards, with their state.
+    """
+
+    def __init__(self, shards, max_monitors=1024, ttl=None, registry=REGISTRY, history_size=0):
+        self.max_monitors = max_monitors
+        self.ttl = ttl
+        self.history_size = history_size
+        self.shards = {}
+        self.ring = HashRing()
+        self.next_shard = 0
+        self.overlaps = Counter(
+            'cvmonitor_sensor_overlaps', 'Number of ocr values dropped since another sensor had the same value', ['sensor'], registry=registry
+        )
+        for _ in range(shards):
+            self.add_shard()
+
+    def shard_max_monitors(self):
+        return -(-self.max_monitors // max(len(self.shards), 1))
+
+    def call(self, requests):
+        """
+        Send requests to shards, and wait for all the results
+        :param requests: list of (shard, op, args)
+        :return: list of results, in the same order
+        :raises ShardError: if any of the requests failed
+        """
+        results = self.call_each(requests)
+        errors = [str(result) for result in results if isinstance(result, ShardError)]
+        if errors:
+            raise ShardError('; '.join(errors))
+        return results
+
+    def call_each(self, requests):
+        """
+        Like call, but a request that failed gets a ShardError as its result, the others still get theirs
+        """
+        shards = sorted({shard for shard, _, _ in requests}, key=lambda shard: shard.shard)
+        for shard in shards:
+            shard.lock.acquire()
+        try:
+            results = self.exchange(requests)
+        finally:
+            for shard in shards:
+                shard.lock.release()
+        if any(isinstance(result, ShardError) for result in results):
+            self.restart_dead_shards()
+        return results
+
+    def exchange(self, requests):
+        """
+        Send the requests and receive their results, the shards should be locked
+        """
+        results = [None] * len(requests)
+        sent = []
+        for i, (shard, op, args) in enumerate(requests):
+            try:
+                shard.send(op, args)
+                sent.append(i)
+            except OSError as e:
+                results[i] = ShardError(f'shard {shard.shard} {op}: {e}')
+        # receive everything that was sent, even after an error, so no answer is left in a pipe
+        for i in sent:
+            shard, op, _ = requests[i]
+            results[i] = self.receive(shard, op)
+        return results
+
+    def receive(self, shard, op):
+        try:
+            result, overlaps, error = shard.recv()
+        except (EOFError, OSError) as e:
+            result, overlaps, error = None, {}, str(e) or type(e).__name__
+        self.count_overlaps(shard, overlaps)
+        return ShardError(f'shard {shard.shard} {op}: {error}') if error else result
+
+    def restart_dead_shards(self):
+        """
+        Replace shard processes that died (their monitors start over)
+        """
+        for shard_id, shard in list(self.shards.items()):
+            if not shard.process.is_alive():
+                logging.error(f'Cleaner shard {shard_id} died, restarting it')
+                shard.stop()
+                self.shards[shard_id] = Shard(shard_id, self.shard_max_monitors(), self.ttl, self.history_size)
+
+    def count_overlaps(self, shard, overlaps):
+        for sensor, total in overlaps.items():
+            delta = total - shard.overlaps.get(sensor, 0)
+            if delta > 0:
+                self.overlaps.labels(sensor).inc(delta)
+        shard.overlaps = overlaps
+
+    def owner(self, monitorId):
+        return self.shards[self.ring.node(monitorId)]
+
+    def clean_segments(self, segments, monitorId, imageId, timestamp=None):
+        return self.clean_batch([(monitorId, imageId, segments, timestamp)])[0]
+
+    def clean_batch(self, items):
+        """
+        Clean the segments of many frames, each shard cleans its frames in parallel with the others
+        :param items: list of (monitorId, imageId, segments, timestamp)
+        :return: the cleaned segments of every item (None for a frame out of order), in the same order. The items of
+            a shard that failed get its ShardError, the items of the other shards are still cleaned.
+        """
+        batches = {}
+        for i, item in enumerate(items):
+            batches.setdefault(self.owner(item[0]), []).append((i, item))
+        results = [None] * len(items)
+        shards = list(batches)
+        for shard, cleaned in zip(shards, self.call_each([(shard, 'clean', [item for _, item in batches[shard]]) for shard in shards])):
+            for n, (i, _) in enumerate(batches[shard]):
+                results[i] = cleaned if isinstance(cleaned, ShardError) else cleaned[n]
+        return results
+
+    def add_shard(self):
+        shard = Shard(self.next_shard, self.max_monitors, self.ttl, self.history_size)
+        self.next_shard += 1
+        others = list(self.shards.values())
+        self.shards[shard.shard] = shard
+        self.ring.add(shard.shard)
+        nodes = self.ring.nodes()
+        # the new shard takes the monitors it now owns from the others
+        states = self.call([(other, 'rebalance', nodes) for other in others])
+        if states:
+            self.call([(shard, 'set_state', merge_states(states))])
+        self.resize(self.max_monitors, self.ttl, self.history_size)
+
+    def remove_shard(self):
+        shard = self.shards.pop(max(self.shards))
+        self.ring.remove(shard.shard)
+        state = self.call([(shard, 'export', None)])[0]
+        shard.stop()
+        self.resize(self.max_monitors, self.ttl, self.history_size)
+        self.set_state(state)
+
+    def resize_shards(self, shards):
+        """
+        Add or remove shards, moving the monitors (and their state) whose owner changed
+        """
+        while len(self.shards) < shards:
+            self.add_shard()
+        while len(self.shards) > max(shards, 1):
+            self.remove_shard()
+
+    def forget(self, monitorId):
+        return self.call([(self.owner(monitorId), 'forget', monitorId)])[0]
+
+    def history(self, monitorId, sensors=None, limit=None):
+        return self.call([(self.owner(monitorId), 'history', (monitorId, sensors, limit))])[0]
+
+    def resize(self, max_monitors, ttl=None, history_size=None):
+        self.max_monitors = max_monitors
+        self.ttl = ttl
+        if history_size is not None:
+            self.history_size = history_size
+        self.call([(shard, 'resize', (self.shard_max_monitors(), ttl, history_size)) for shard in self.shards.values()])
+
+    def count_monitors(self):
+        return sum(count for count, _ in self.call([(shard, 'stats', None) for shard in self.shards.values()]))
+
+    def monitors_nbytes(self):
+        return sum(nbytes for _, nbytes in self.call([(shard, 'stats', None) for shard in self.shards.values()]))
+
+    def get_state(self):
+        return merge_states(self.call([(shard, 'get_state', None) for shard in self.shards.values()]))
+
+    def set_state(self, state):
+        """
+        Restore the state of monitors, each on the shard that owns it
+        """
+        owners = np.array([self.ring.node(str(monitorId)) for monitorId in state['monitors']], int)
+        self.call([(shard, 'set_state', select_state(state, owners == shard.shard)) for shard in self.shards.values()])
+        return len(state['monitors'])
+
+    def load_state(self, path):
+        with np.load(path, allow_pickle=False) as state:
+            return self.set_state(dict(state))
+
+    def close(self):
+        for shard in self.shards.values():
+            shard.stop()
+        self.shards = {}
@@ -1,15 +1,27 @@
+import io
 import os
+import struct
 import time
+from collections import Counter
 
+import cv2
 import imageio
 import numpy as np
+import pytest
+from prometheus_client import CollectorRegistry
 from pylab import imshow, show  # noqa F401
 
 from .. import image_align, qr
-from ..aug_clean import MonitorValues
-from ..device_fields import Cleaner, PostProcessor, get_fields_info
+from ..aug_clean import MAX_REORDER, MonitorValues, SensorHistory, SensorStore
+from ..benchmark import legacy_cleanup_field
+from ..config import Settings
+from ..cv import ComputerVision, ResultLogger
+from ..executor import Executor, Overloaded
+from ..device_fields import Cleaner, PostProcessor, compile_field_cleaner, get_fields_info, save_state
 from ..image_align import align_by_qrcode
 from ..qr import find_qrcode
+from ..shard import HashRing, ShardError, ShardedCleaner
+from ..utils import LRUCache, decode_gray, encode_image, parse_timestamp
 
 
 def test_pdf_generate():
@@ -221,3 +233,523 @@ def test_aug_cleaning():
 
     augs_dict = {"name": "SpO2", "value": ["NNATO372", "10"]}
     assert mv.get_latest_valid_value(augs_dict) == "100"
+
+
+def test_executor():
+    registry = CollectorRegistry()
+    ex = Executor(1, 1, registry)
+    try:
+        assert ex.run(qr.read_codes_from, open(os.path.dirname(__file__) + "/data/barcode.png", "rb").read())[0]["data"] == "Foramenifera"
+        futures = [ex.submit(time.sleep, 0.5), ex.submit(time.sleep, 0.5)]
+        with pytest.raises(Overloaded):
+            ex.submit(time.sleep, 0.5)
+        assert registry.get_sample_value("cvmonitor_pool_queued") == 1
+        assert registry.get_sample_value("cvmonitor_pool_rejected_total") == 1
+        [f.result() for f in futures]
+        assert ex.pending == 0
+    finally:
+        ex.close()
+
+
+def test_executor_inline():
+    ex = Executor(0, 0, CollectorRegistry())
+    assert ex.run(max, 1, 2) == 2
+    with pytest.raises(ValueError):
+        ex.run(int, "a")
+
+
+def test_settings():
+    settings = Settings.from_env({"CVMONITOR_SKIP_ALIGN": "FALSE", "CVMONITOR_QR_BOUNDERY_SIZE": "20.5", "CVMONITOR_LOG_LEVEL": "info"})
+    assert settings.align_by_qr
+    assert settings.qr_boundery_size == 20.5
+    assert settings.log_level == "INFO"
+    assert Settings.from_env({}) == Settings()
+    for bad in [{"CVMONITOR_ORIENT_BY_QR": "yes"}, {"CVMONITOR_QR_TARGET_SIZE": "0"}, {"CVMONITOR_PORT": "http"}, {"CVMONITOR_LOG_LEVEL": "LOUD"},
+                {"CVMONITOR_JPEG_QUALITY": "101"}]:
+        with pytest.raises(ValueError):
+            Settings.from_env(bad)
+
+
+def test_find_qrcode_scaled():
+    for name in ["test.jpg", "another.jpg", "generated_from_pdf.jpg", "barcode_monitor.jpg"]:
+        data = open(os.path.dirname(__file__) + "/data/" + name, "rb").read()
+        image = imageio.imread(data)
+        full = find_qrcode(image, "")
+        for scale in [2, 4, 8]:
+            scaled = qr.find_qrcode_scaled(data, image, "", scale)
+            assert scaled.data == full.data
+            assert np.abs(np.array(scaled.polygon) - np.array(full.polygon)).max() <= 2 * scale
+
+
+def test_orient_by_qr_scaled():
+    for i in [1, 2, 3, 4]:
+        data = open(os.path.dirname(__file__) + f"/data/bad{i}.jpg", "rb").read()
+        image, _, rotation = image_align.get_oriented_image(io.BytesIO(data), use_qr=True)
+        scaled_image, _, scaled_rotation = image_align.get_oriented_image(io.BytesIO(data), use_qr=True, search_scale=4)
+        assert rotation == scaled_rotation
+        assert np.array_equal(image, scaled_image)
+
+
+def test_exif_orientation():
+    for name in ["sample.jpeg", "sample_up.jpg", "test.jpg", "bad1.jpg"]:
+        data = open(os.path.dirname(__file__) + "/data/" + name, "rb").read()
+        assert image_align.read_exif_orientation(memoryview(data)) == image_align.read_exifread_orientation(io.BytesIO(data))
+    data = open(os.path.dirname(__file__) + "/data/sample.jpeg", "rb").read()
+    assert image_align.get_exif_rotation(io.BytesIO(data))[1] == -90
+    # Malformed files fall back to exifread
+    with pytest.raises(ValueError):
+        image_align.read_exif_orientation(memoryview(data[:20]))
+    assert image_align.get_exif_rotation(io.BytesIO(data[:20]))[1] is None
+    assert image_align.get_exif_rotation(io.BytesIO(open(os.path.dirname(__file__) + "/data/qrcode.png", "rb").read()))[1] is None
+
+
+def test_find_qrcode_stages():
+    image = imageio.imread(os.path.dirname(__file__) + "/data/test.jpg")
+    qrcode = find_qrcode(image, "")
+    # The code is at the top left, so the first (cheapest) stage finds it
+    assert qrcode.stage == "quadrant-coarse"
+    full = find_qrcode(image, "", [("frame", "frame", 1, False, None)])
+    assert full.stage == "frame"
+    assert full.data == qrcode.data
+    assert np.abs(np.array(full.polygon) - np.array(qrcode.polygon)).max() <= 2
+    # Stages over budget are skipped, stages without a budget always run
+    assert find_qrcode(image, "", [("quadrant", "quadrant", 1, False, -1.0)]) is None
+    assert find_qrcode(image, "", [("quadrant", "quadrant", 1, False, -1.0), ("frame", "frame", 1, False, None)]).stage == "frame"
+
+
+def test_lru_cache():
+    now = [0.0]
+    cache = LRUCache(2, ttl=10, clock=lambda: now[0])
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1
+    cache.set("c", 3)
+    assert "b" not in cache
+    assert cache.get("a") == 1 and cache.get("c") == 3
+    now[0] = 11
+    assert cache.get("a") is None
+    assert len(cache) == 1
+
+
+def test_align_frame_qr_hint():
+    for i in [1, 2, 3, 4]:
+        data = open(os.path.dirname(__file__) + f"/data/bad{i}.jpg", "rb").read()
+        first = image_align.align_frame(data, use_exif=False, use_qr=True)
+        assert first["qr"] is not None
+        second = image_align.align_frame(data, use_exif=False, use_qr=True, qr_hint=first["qr"])
+        assert second["qr_stage"] == "cached"
+        assert second["qr"]["rotation"] == first["qr"]["rotation"]
+        assert np.array_equal(second["image"], first["image"])
+        # A hint for another monitor is not used
+        other = dict(first["qr"], monitorId="other")
+        assert image_align.align_frame(data, use_exif=False, use_qr=True, qr_hint=other)["qr_stage"] != "cached"
+
+
+def test_smooth_corners():
+    corners = np.array([[10, 10], [110, 10], [110, 110], [10, 110]], np.float32)
+    assert image_align.smooth_corners(corners, None)[1] is False
+    same, reused = image_align.smooth_corners(corners + 0.5, corners)
+    assert reused and np.array_equal(same, corners)
+    smoothed, reused = image_align.smooth_corners(corners + 4, corners, smoothing=0.5)
+    assert not reused and np.allclose(smoothed, corners + 2)
+    # The camera moved, don't smooth
+    moved, reused = image_align.smooth_corners(corners + 50, corners)
+    assert not reused and np.array_equal(moved, corners + 50)
+
+
+def test_align_frame_homography():
+    data = open(os.path.dirname(__file__) + "/data/barcode_monitor.jpg", "rb").read()
+    options = dict(use_exif=False, use_qr=True, qrprefix="http", align=True)
+    first = image_align.align_frame(data, **options)
+    second = image_align.align_frame(data, qr_hint=first["qr"], **options)
+    assert second["qr"]["homography"] is first["qr"]["homography"]
+    first_image = np.asarray(imageio.imread(first["image"].tobytes())).astype(float)
+    second_image = np.asarray(imageio.imread(second["image"].tobytes())).astype(float)
+    assert first_image.shape == second_image.shape
+    assert np.mean(np.abs(first_image - second_image)) < 2.0
+    # downscaled and grayscale in the same warp, with or without the remap tables
+    for qr_hint in [None, first["qr"]]:
+        small = image_align.align_frame(data, qr_hint=qr_hint, max_dim=120, gray=True, image_format=".png", **options)
+        small_image = np.asarray(imageio.imread(small["image"].tobytes())).astype(float)
+        assert small_image.ndim == 2 and max(small_image.shape) == 120
+        expected = cv2.resize(first_image.mean(-1), small_image.shape[::-1], interpolation=cv2.INTER_AREA)
+        assert np.mean(np.abs(small_image - expected)) < 10.0
+
+
+def test_remap_cache_key():
+    image = np.asarray(imageio.imread(os.path.dirname(__file__) + "/data/barcode_monitor.jpg"))
+    detected_qrcode = find_qrcode(image, "http")
+    homography, _ = image_align.get_smoothed_homography(image.shape, detected_qrcode)
+    # another homography of the same monitor with the same version, e.g. after the qr hint expired
+    shifted = dict(homography, M=(np.array([[1, 0, 7], [0, 1, 3], [0, 0, 1]]) @ np.asarray(homography["M"])).tolist())
+    for previous in [homography, shifted]:
+        aligned, used = image_align.align_by_qrcode_smoothed(image, detected_qrcode, "monitor", previous=previous)
+        assert used is previous
+        expected = cv2.warpPerspective(image, np.asarray(previous["M"]), tuple(previous["size"]))
+        assert np.mean(np.abs(aligned.astype(float) - expected)) < 1.0
+
+
+def test_rotation_matrix():
+    image = np.arange(35, dtype=np.uint8).reshape(5, 7)
+    for rotation in [None, 0, 90, -90, 180]:
+        R, (height, width) = image_align.get_rotation_matrix(rotation, *image.shape)
+        rotated = cv2.warpPerspective(image, R, (width, height), flags=cv2.INTER_NEAREST)
+        assert np.array_equal(rotated, image_align.rotate_image(image, rotation))
+
+
+def with_exif_orientation(jpeg, orientation):
+    """
+    Insert an exif APP1 segment with only the orientation tag after the SOI of a jpeg
+    """
+    tiff = b"MM\x00\x2a" + struct.pack(">I", 8) + struct.pack(">HHHIHHI", 1, 0x0112, 3, 1, orientation, 0, 0)
+    return jpeg[:2] + b"\xff\xe1" + struct.pack(">H", len(tiff) + 8) + b"Exif\0\0" + tiff + jpeg[2:]
+
+
+def test_align_rotated_frame():
+    data = open(os.path.dirname(__file__) + "/data/barcode_monitor.jpg", "rb").read()
+    options = dict(use_qr=True, qrprefix="http", align=True, image_format=".png")
+    upright = np.asarray(imageio.imread(image_align.align_frame(data, use_exif=False, **options)["image"].tobytes())).astype(float)
+    image = np.asarray(imageio.imread(data))
+    # rotated by the qr code position, and by the exif orientation (which used to skip the qr code search)
+    frames = [
+        (False, cv2.imencode(".png", cv2.rotate(image, rotate)[..., ::-1])[1].tobytes(), rotation)
+        for rotate, rotation in [(cv2.ROTATE_90_COUNTERCLOCKWISE, 90), (cv2.ROTATE_90_CLOCKWISE, -90), (cv2.ROTATE_180, 180)]
+    ]
+    frames.append((True, with_exif_orientation(cv2.imencode(".jpg", cv2.rotate(image, cv2.ROTATE_90_CLOCKWISE)[..., ::-1])[1].tobytes(), 6), -90))
+    for use_exif, frame, rotation in frames:
+        aligned = None
+        for _ in range(2):
+            # then with the qr code and homography of the first frame
+            aligned = image_align.align_frame(frame, use_exif=use_exif, qr_hint=aligned and aligned["qr"], **options)
+            assert aligned["qr"]["rotation"] == rotation
+            # the qr code and around it are where they are in the upright frame (the far corners of the canvas
+            # move with the pixel error of the qr corners)
+            result = np.asarray(imageio.imread(aligned["image"].tobytes())).astype(float)
+            assert np.mean(np.abs(result[:200, :200] - upright[:200, :200])) < 5.0
+
+
+def test_result_logger(tmp_path):
+    registry = CollectorRegistry()
+    logger = ResultLogger(str(tmp_path) + "/", queue_size=1, registry=registry)
+    for i in range(1, 4):
+        logger.log_ocr(b"jpeg", None, {"cleaned": [i]}, i, "monitor")
+    logger.close()
+    written = sorted(p.name for p in tmp_path.glob("*/*.json"))
+    dropped = registry.get_sample_value("cvmonitor_result_log_dropped_total")
+    assert len(written) + dropped == 3
+    assert written and len(list(tmp_path.glob("*/*.jpg"))) == len(written)
+
+    logger = ResultLogger(str(tmp_path) + "/", registry=CollectorRegistry())
+    logger.log_ocr(None, None, {"cleaned": []}, 10, "monitor")
+    logger.flush()
+    assert (next(tmp_path.glob("*/monitor_10.json"))).exists()
+    logger.close()
+
+
+def test_compile_field_cleaner():
+    fields = get_fields_info()
+    rnd = np.random.RandomState(0)
+    alphabet = list("0123456789./: ()aOl-\n")
+    values = ["".join(rnd.choice(alphabet, rnd.randint(0, 12))) for _ in range(200)] + ["115 /45", "120 1 80\n90/60"]
+    for name, info in fields.items():
+        cleaner = compile_field_cleaner(info)
+        for value in values:
+            assert cleaner(value) == legacy_cleanup_field(info, value), (name, value)
+
+
+def test_cleaner_keeps_input():
+    segments = [
+        {"left": 1, "top": 2, "right": 3, "bottom": 4, "name": "IBP", "value": "120 /80", "level": "aug"},
+        {"name": "IBP", "value": "12O/80", "level": "crop", "left": 10, "top": 20, "right": 30, "bottom": 40},
+        {"value": " 52", "name": "HR"},
+    ]
+    original = [dict(s) for s in segments]
+    cleaned = Cleaner(get_fields_info()).clean_segments(segments, "monitor", 1)
+    assert segments == original
+    assert [list(s.keys()) for s in cleaned] == [
+        ["value", "name"],
+        ["left", "top", "right", "bottom", "name", "value", "level"],
+        ["left", "top", "right", "bottom", "name", "value", "level"],
+    ]
+    assert [(s["name"], s["value"], s["left"]) for s in cleaned[1:]] == [("IBP-Systole", "120", 10), ("IBP-Diastole", "80", 10)]
+
+
+def test_cleaner_monitor_state():
+    cleaner = Cleaner(get_fields_info(), max_monitors=2)
+    segments = [{"name": "HR", "value": "52"}]
+    for monitor in ["a", "b", None, "c"]:
+        cleaner.clean_segments(segments, monitor, 1)
+    assert cleaner.count_monitors() == 2
+    assert cleaner.monitors_nbytes() > 0
+    assert not cleaner.forget("a")
+    assert cleaner.forget("b")
+    assert cleaner.count_monitors() == 1
+
+
+def test_sensor_store():
+    store = SensorStore(["HR", "RR"], slots=1)
+    a = MonitorValues(get_fields_info(), store)
+    b = MonitorValues(get_fields_info(), store)
+    assert (a.slot, b.slot) == (0, 1)
+    assert a.get_latest_valid_value({"name": "HR", "value": ["80"]}) == "80"
+    assert b.get_latest_valid_value({"name": "HR", "value": [""]}) is None
+    # An unknown sensor adds a column
+    a.get_latest_valid_value({"name": "Extra", "value": ["12"]})
+    assert store.times.shape[1] == 3
+    assert a.last_valid_value("HR") == "80"
+    a.release()
+    c = MonitorValues(get_fields_info(), store)
+    assert c.slot == 0 and c.last_valid_value("HR") is None
+
+    cleaner = Cleaner(get_fields_info(), max_monitors=1)
+    cleaner.clean_segments([{"name": "HR", "value": "80"}], "a", 1)
+    cleaner.clean_segments([{"name": "HR", "value": "81"}], "b", 1)
+    assert len(cleaner.store.free) == len(cleaner.store.times) - 1
+
+
+def test_sensor_overlap():
+    registry = CollectorRegistry()
+    cleaner = Cleaner(get_fields_info(), registry=registry)
+    res = cleaner.clean_segments([{"name": "HR", "value": "52"}], "monitor", 1)
+    assert res[0]["value"] == "52"
+    res = cleaner.clean_segments([{"name": "RR", "value": "52"}, {"name": "RR", "value": "15"}], "monitor", 2)
+    assert res[0]["value"] == "15"
+    assert registry.get_sample_value("cvmonitor_sensor_overlaps_total", {"sensor": "RR"}) == 1
+    # HR changed, 52 is not taken anymore
+    cleaner.clean_segments([{"name": "HR", "value": "60"}], "monitor", 3)
+    res = cleaner.clean_segments([{"name": "RR", "value": "52"}], "monitor", 4)
+    assert res[0]["value"] == "52"
+
+
+def test_cleaner_state_snapshot(tmp_path):
+    cleaner = Cleaner(get_fields_info())
+    cleaner.clean_segments([{"name": "HR", "value": "52"}, {"name": "RR", "value": "15"}], "monitor", 1)
+    path = str(tmp_path / "state.npz")
+    save_state(path, cleaner.get_state())
+
+    restored = Cleaner(get_fields_info())
+    assert restored.load_state(path) == 1
+    # Within the fallback window, a bad reading gets the value from before the restart
+    res = restored.clean_segments([{"name": "HR", "value": "5000"}], "monitor", 2)
+    assert res[0]["value"] == "52"
+    assert restored.monitors.get("monitor").value_sensors["15"] == {"RR"}
+
+
+def test_computer_vision_state_snapshot(tmp_path):
+    settings = Settings(workers=0, state_snapshot=str(tmp_path / "state.npz"))
+    cv = ComputerVision(settings, CollectorRegistry())
+    cv.cleaner.clean_segments([{"name": "HR", "value": "52"}], "monitor", 1)
+    cv.close()
+    assert os.path.exists(settings.state_snapshot)
+    cv = ComputerVision(settings, CollectorRegistry())
+    assert cv.cleaner.clean_segments([{"name": "HR", "value": ""}], "monitor", 2)[0]["value"] == "52"
+    cv.close()
+
+
+def test_hash_ring():
+    ring = HashRing([0, 1])
+    monitors = [f"monitor-{i}" for i in range(200)]
+    owners = {m: ring.node(m) for m in monitors}
+    assert set(owners.values()) == {0, 1}
+    ring.add(2)
+    moved = [m for m in monitors if ring.node(m) != owners[m]]
+    # only monitors taken by the new shard move
+    assert moved and all(ring.node(m) == 2 for m in moved)
+    ring.remove(2)
+    assert {m: ring.node(m) for m in monitors} == owners
+
+
+def test_sharded_cleaner():
+    cleaner = ShardedCleaner(2, max_monitors=64, registry=CollectorRegistry(), history_size=4)
+    try:
+        monitors = [f"monitor-{i}" for i in range(8)]
+        cleaned = cleaner.clean_batch([(m, 1, [{"name": "HR", "value": str(60 + i)}], None) for i, m in enumerate(monitors)])
+        assert [segments[0]["value"] for segments in cleaned] == [str(60 + i) for i in range(8)]
+        assert cleaner.count_monitors() == 8
+        assert cleaner.history("monitor-3")["HR"]["values"] == ["63"]
+        assert cleaner.history("unknown") is None
+        cleaner.resize_shards(3)
+        cleaner.resize_shards(1)
+        # the state moved with the monitors
+        state = cleaner.get_state()
+        assert sorted(state["monitors"]) == monitors
+        assert cleaner.forget("monitor-0")
+        assert cleaner.count_monitors() == 7
+    finally:
+        cleaner.close()
+
+
+def test_sharded_cleaner_failure():
+    cleaner = ShardedCleaner(2, registry=CollectorRegistry())
+    try:
+        monitors = [f"monitor-{i}" for i in range(8)]
+        items = [(m, 1, [{"name": "HR", "value": "52"}], None) for m in monitors]
+        cleaner.shards[0].process.kill()
+        cleaner.shards[0].process.join()
+        # only the frames of the dead shard fail
+        cleaned = cleaner.clean_batch(items)
+        for m, segments in zip(monitors, cleaned):
+            if cleaner.ring.node(m) == 0:
+                assert isinstance(segments, ShardError)
+            else:
+                assert segments[0]["value"] == "52"
+        # and it was restarted
+        assert all(not isinstance(segments, ShardError) for segments in cleaner.clean_batch(items))
+    finally:
+        cleaner.close()
+
+
+def test_computer_vision_sharded(tmp_path):
+    settings = Settings(workers=0, cleaner_shards=2, state_snapshot=str(tmp_path / "state.npz"))
+    cv = ComputerVision(settings, CollectorRegistry())
+    cleaned = cv.process_ocr_batch([{"monitorId": m, "imageId": 1, "segments": [{"name": "HR", "value": "52"}]} for m in "abc"])
+    assert [segments[0]["value"] for segments in cleaned] == ["52"] * 3
+    cv.settings = settings._replace(cleaner_shards=3)
+    assert len(cv.cleaner.shards) == 3
+    cv.close()
+    # a snapshot of a sharded cleaner restores on a single one
+    cv = ComputerVision(settings._replace(cleaner_shards=0), CollectorRegistry())
+    assert cv.process_ocr({"monitorId": "b", "imageId": 2, "segments": [{"name": "HR", "value": ""}]})[0]["value"] == "52"
+    cv.close()
+
+
+def test_sensor_history():
+    history = SensorHistory(size=5)
+    assert history.mode() is None and history.median() is None
+    rng = np.random.default_rng(0)
+    readings = [str(v) for v in rng.integers(50, 56, 40)] + ["120/80", "120/80"]
+    for i, value in enumerate(readings):
+        history.add(i, value)
+        window = readings[max(i - 4, 0):i + 1]
+        numbers = [float(v) for v in window if "/" not in v]
+        assert len(history) == len(window)
+        assert history.series()[1].tolist() == window
+        assert history.series(2)[0].tolist() == list(range(max(i - 1, 0), i + 1))
+        counts = Counter(window)
+        assert counts[history.mode()] == max(counts.values())
+        assert history.min() == (min(numbers) if numbers else None)
+        assert history.max() == (max(numbers) if numbers else None)
+        assert history.median() == (np.median(numbers) if numbers else None)
+    assert history.mode() == "120/80"
+
+
+def test_cleaner_history():
+    cleaner = Cleaner(get_fields_info(), history_size=3)
+    for i, value in enumerate(["52", "53", "", "53", "54"]):
+        cleaner.clean_segments([{"name": "HR", "value": value}, {"name": "RR", "value": "15"}], "monitor", i)
+    history = cleaner.history("monitor", ["HR"])
+    # only valid readings are kept
+    assert list(history) == ["HR"] and history["HR"]["values"] == ["53", "53", "54"]
+    assert history["HR"]["mode"] == "53" and history["HR"]["median"] == 53 and history["HR"]["max"] == 54
+    assert cleaner.history("monitor", limit=1)["RR"]["values"] == ["15"]
+    assert cleaner.monitors_nbytes() > cleaner.store.nbytes()
+    # reading the history doesn't refresh the monitor
+    cleaner.clean_segments([{"name": "HR", "value": "55"}], "other", 1)
+    cleaner.history("monitor")
+    assert cleaner.monitors.keys() == ["monitor", "other"]
+    # off by default, and changing the size starts the windows over
+    assert Cleaner(get_fields_info()).history_size == Settings().history_size == 0
+    cleaner.resize(1024, history_size=0)
+    assert cleaner.history("monitor") == {}
+
+
+def test_parse_timestamp():
+    assert parse_timestamp("2020-04-01T10:00:00") == parse_timestamp("2020-04-01T12:00:00+02:00") == 1585735200
+    assert parse_timestamp("2020-04-01T10:00:00Z") == parse_timestamp(1585735200) == parse_timestamp("1585735200")
+    assert parse_timestamp(None) is None and parse_timestamp("yesterday") is None
+
+
+def test_cleaner_event_time():
+    cleaner = Cleaner(get_fields_info())
+    start = time.time() - 3600
+
+    def clean(imageId, value, t):
+        return cleaner.clean_segments([{"name": "HR", "value": value}], "monitor", imageId, start + t)[0]["value"]
+    assert clean(1, "52", 0) == "52"
+    # the window is in capture time, not in the (much later) processing time
+    assert clean(2, "", 5) == "52"
+    assert clean(3, "", 20) != "52"
+
+
+def test_cleaner_out_of_order():
+    cleaner = Cleaner(get_fields_info())
+    segments = [{"name": "HR", "value": "52"}]
+    assert cleaner.clean_segments(segments, "monitor", 10) is not None
+    assert cleaner.clean_segments(segments, "monitor", 9) is None
+    assert cleaner.clean_segments(segments, "monitor", 10) is not None
+    # a client that restarts its count is not out of order
+    assert cleaner.clean_segments(segments, "monitor", 10 - MAX_REORDER - 1) is not None
+    # the timestamp decides when both frames have one
+    assert cleaner.clean_segments(segments, "monitor", 1, 1000.0) is not None
+    assert cleaner.clean_segments(segments, "monitor", 2, 999.0) is None
+    assert cleaner.clean_segments(segments, "monitor", 0, 1001.0) is not None
+    assert cleaner.clean_segments(segments, None, 0) is not None
+
+
+def test_cleaner_future_timestamp():
+    cleaner = Cleaner(get_fields_info(), ttl=60)
+    segments = [{"name": "HR", "value": "52"}]
+    now = time.time()
+    # a clock jump, milliseconds read as seconds and inf are ignored, rather than making every later frame late
+    for imageId, timestamp in enumerate([now + 3600, now * 1000, "inf", "nan"]):
+        assert cleaner.clean_segments(segments, "monitor", imageId, timestamp) is not None
+    assert cleaner.monitors.get("monitor").last_time is None
+    assert cleaner.clean_segments(segments, "monitor", 10, now) is not None
+    assert cleaner.clean_segments(segments, "monitor", 11, now + 1) is not None
+    # a late frame doesn't refresh its monitor in the cache
+    assert cleaner.clean_segments(segments, "other", 1, now) is not None
+    assert cleaner.clean_segments(segments, "monitor", 12, now - 1) is None
+    assert cleaner.monitors.keys() == ["monitor", "other"]
+
+
+def test_encode_image():
+    image = np.asarray(imageio.imread(os.path.dirname(__file__) + "/data/sample.jpeg"))
+    encoded = encode_image(image, quality=90)
+    assert encoded.dtype == np.uint8 and encoded.ndim == 1
+    decoded = np.asarray(imageio.imread(memoryview(encoded)))
+    assert decoded.shape == image.shape
+    # RGB in, RGB out
+    assert np.mean(np.abs(decoded.astype(float) - image)) < 3.0
+    assert len(encode_image(image, quality=30)) < len(encoded)
+    # the scratch buffer is reused, not the output
+    assert not np.shares_memory(encode_image(image), encoded)
+
+
+def test_decode_gray():
+    for name in ["sample.jpeg", "barcode.png", "qrcode.png"]:
+        data = open(os.path.dirname(__file__) + "/data/" + name, "rb").read()
+        image = np.asarray(imageio.imread(data))
+        gray = decode_gray(memoryview(data))
+        # as decoded, the exif orientation of sample.jpeg is not applied
+        assert gray.ndim == 2 and gray.shape == image.shape[:2]
+        if image.ndim == 3:
+            image = cv2.cvtColor(image[..., :3], cv2.COLOR_RGB2GRAY)
+        assert np.mean(np.abs(gray.astype(float) - image)) < 2.0
+    # the qr search finds the same code on the luminance
+    data = open(os.path.dirname(__file__) + "/data/barcode_monitor.jpg", "rb").read()
+    assert find_qrcode(decode_gray(data), "http").polygon == find_qrcode(np.asarray(imageio.imread(data)), "http").polygon
+
+
+def test_align_segments():
+    data = open(os.path.dirname(__file__) + "/data/barcode_monitor.jpg", "rb").read()
+    options = dict(use_exif=False, use_qr=True, qrprefix="http")
+    aligned = image_align.align_frame(data, align=True, image_format=".png", **options)
+    full = np.asarray(imageio.imread(aligned["image"].tobytes())).astype(float)
+    segments = [{"name": "a", "left": 10, "top": 20, "right": 90, "bottom": 60}, {"name": "b", "left": 150.5, "top": 30, "right": 1e6, "bottom": 70}]
+    result = image_align.align_segments(data, segments, qr_hint=aligned["qr"], image_format=".png", **options)
+    assert result["monitorId"] == aligned["monitorId"] and result["qr"]["homography"] is aligned["qr"]["homography"]
+    # the second box is clipped to the aligned image
+    assert result["segments"][1] == {"name": "b", "left": 150, "top": 30, "right": full.shape[1], "bottom": 70}
+    for box, tile in zip(result["segments"], result["tiles"]):
+        tile = np.asarray(imageio.imread(tile.tobytes())).astype(float)
+        crop = full[box["top"]:box["bottom"], box["left"]:box["right"]]
+        assert tile.shape == crop.shape
+        assert np.mean(np.abs(tile - crop)) < 1.0
+    with pytest.raises(ValueError):
+        image_align.align_segments(data, [{"name": "out", "left": -20, "top": 0, "right": -10, "bottom": 10}], **options)
+    with pytest.raises(ValueError):
+        image_align.align_segments(data, [{"name": "no box"}], **options)
+    with pytest.raises(ValueError):
+        image_align.get_segment_boxes([1], (100, 100))
+    with pytest.raises(ValueError):
+        image_align.get_segment_boxes(segments, (1000, 1000), max_pixels=1000)
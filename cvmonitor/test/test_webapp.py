@@ -1,11 +1,18 @@
 import base64
+import io
+import json
 import os
+import signal
+import struct
 
+import gevent
 import imageio
 import numpy as np
 from flask import url_for
 from pylab import imshow, show  # noqa F401
 
+from ..utils import split_length_prefixed
+
 
 def test_ping(client):
 
@@ -53,6 +60,7 @@ def test_align(client):
     )
     res_image = np.asarray(imageio.imread(res.data))
     assert res_image.shape[0] > 0
+    assert res.content_type == "image/jpeg" and res.content_length == len(res.data)
 
 
 def test_align_whole_image(client):
@@ -142,3 +150,262 @@ def test_client_ocr(client):
         ],
     ):
         assert e.items() <= r.items()
+
+
+def test_align_images(client, server, monkeypatch):
+    images = [
+        open(os.path.dirname(__file__) + "/data/qrcode.png", "rb").read(),
+        open(os.path.dirname(__file__) + "/data/barcode_monitor.jpg", "rb").read(),
+        b"not an image",
+    ]
+    monkeypatch.setenv("CVMONITOR_ORIENT_BY_QR", "TRUE")
+    monkeypatch.setenv("CVMONITOR_QR_PREFIX", "http")
+    monkeypatch.setenv("CVMONITOR_SKIP_ALIGN", "FALSE")
+    server.reload()
+    res = client.post(
+        url_for("cv.align_images"),
+        data={f"image{i}": (io.BytesIO(image), f"{i}.jpg") for i, image in enumerate(images)},
+        content_type="multipart/form-data",
+    )
+    assert len(res.json) == 3
+    for image, r in zip(images, res.json):
+        if image == images[-1]:
+            continue
+        assert r["error"] is None
+        single = client.post(url_for("cv.align_image"), data=image, headers={"content-type": "image/jpeg"})
+        assert r["monitorId"] == single.headers["X-MONITOR-ID"]
+        res_image = np.asarray(imageio.imread(base64.b64decode(r["image"])))
+        single_image = np.asarray(imageio.imread(single.data))
+        assert res_image.shape == single_image.shape
+        assert np.array_equal(res_image, single_image)
+    assert res.json[2]["error"]
+    assert res.json[2]["image"] is None
+
+
+def test_align_images_length_prefixed(client, server, monkeypatch):
+    images = [
+        open(os.path.dirname(__file__) + "/data/qrcode.png", "rb").read(),
+        open(os.path.dirname(__file__) + "/data/test.jpg", "rb").read(),
+    ]
+    res = client.post(
+        url_for("cv.align_images"),
+        data=b"".join(struct.pack(">I", len(image)) + image for image in images),
+        headers={"content-type": "application/octet-stream"},
+    )
+    assert [r["error"] for r in res.json] == [None, None]
+
+    res = client.post(
+        url_for("cv.align_images"),
+        data=struct.pack(">I", 100) + b"short",
+        headers={"content-type": "application/octet-stream"},
+    )
+    assert res.status_code == 400
+
+    monkeypatch.setenv("CVMONITOR_ALIGN_MAX_FRAMES", "1")
+    server.reload()
+    res = client.post(
+        url_for("cv.align_images"),
+        data=b"".join(struct.pack(">I", len(image)) + image for image in images),
+        headers={"content-type": "application/octet-stream"},
+    )
+    assert res.status_code == 413
+
+
+def test_align_images_gevent(app):
+    # Run under the same gevent server as production, and make sure the loop keeps serving while the pool works
+    import gevent
+    import requests
+    from gevent.pywsgi import WSGIServer
+
+    server = WSGIServer(("127.0.0.1", 0), app, log=None)
+    server.start()
+    try:
+        url = f"http://127.0.0.1:{server.server_port}"
+        image = open(os.path.dirname(__file__) + "/data/barcode_monitor.jpg", "rb").read()
+        batch = gevent.spawn(
+            requests.post, url + "/v1/align_images", data=struct.pack(">I", len(image)) + image, timeout=60
+        )
+        pings = []
+        while not batch.ready():
+            pings.append(requests.get(url + "/ping/", timeout=5).text)
+            gevent.sleep(0.05)
+        res = batch.get()
+        assert res.status_code == 200
+        assert res.json()[0]["error"] is None
+        assert pings and all(p == "pong" for p in pings)
+    finally:
+        server.stop()
+
+
+def test_pool_metrics(client):
+    client.post(
+        url_for("cv.detect_codes"),
+        data=open(os.path.dirname(__file__) + "/data/barcode.png", "rb").read(),
+        headers={"content-type": "application/png"},
+    )
+    metrics = client.get("/metrics").data.decode()
+    assert "cvmonitor_pool_workers" in metrics
+    assert "cvmonitor_pool_busy 0.0" in metrics
+
+
+def test_config(client, server, monkeypatch):
+    assert client.get(url_for("cv.get_config")).json["qr_target_size"] == 100
+
+    monkeypatch.setenv("CVMONITOR_QR_TARGET_SIZE", "150")
+    server.handle_reload_signal()
+    os.kill(os.getpid(), signal.SIGHUP)
+    gevent.sleep(0.1)
+    assert client.get(url_for("cv.get_config")).json["qr_target_size"] == 150
+
+    # Bad values are ignored
+    monkeypatch.setenv("CVMONITOR_QR_TARGET_SIZE", "big")
+    server.reload()
+    assert client.get(url_for("cv.get_config")).json["qr_target_size"] == 150
+
+
+def test_qr_stage_metrics(client, server, monkeypatch):
+    monkeypatch.setenv("CVMONITOR_ORIENT_BY_QR", "TRUE")
+    monkeypatch.setenv("CVMONITOR_QR_PREFIX", "http")
+    server.reload()
+    image = open(os.path.dirname(__file__) + "/data/barcode_monitor.jpg", "rb").read()
+    client.post(url_for("cv.align_image"), data=image, headers={"content-type": "image/jpeg"})
+    assert 'cvmonitor_qr_stage_total{stage="quadrant"} 1.0' in client.get("/metrics").data.decode()
+
+
+def test_qr_cache(client, server, monkeypatch):
+    monkeypatch.setenv("CVMONITOR_ORIENT_BY_QR", "TRUE")
+    monkeypatch.setenv("CVMONITOR_QR_PREFIX", "http")
+    server.reload()
+    image = open(os.path.dirname(__file__) + "/data/barcode_monitor.jpg", "rb").read()
+    first = client.post(url_for("cv.align_image"), data=image, headers={"content-type": "image/jpeg"})
+    monitor_id = first.headers["X-MONITOR-ID"]
+    second = client.post(
+        url_for("cv.align_image"), data=image, headers={"content-type": "image/jpeg", "X-MONITOR-ID": monitor_id}
+    )
+    assert second.headers["X-MONITOR-ID"] == monitor_id
+    assert second.data == first.data
+    metrics = client.get("/metrics").data.decode()
+    assert "cvmonitor_qr_cache_hits_total 1.0" in metrics
+    assert 'cvmonitor_qr_stage_total{stage="cached"} 1.0' in metrics
+
+
+def test_run_ocr_stream(client):
+    messages = [
+        {"monitorId": "a", "imageId": 1, "segments": [{"left": 0, "top": 0, "right": 10, "bottom": 10, "name": "HR", "value": " 52"}]},
+        "not json",
+        {"monitorId": "a", "imageId": 2, "segments": [{"left": 0, "top": 0, "right": 10, "bottom": 10, "name": "RR", "value": "(15)"}]},
+    ]
+    body = "".join((m if isinstance(m, str) else json.dumps(m)) + "\n" for m in messages)
+    res = client.post(url_for("cv.run_ocr_stream"), data=body, headers={"content-type": "application/x-ndjson"})
+    results = [json.loads(line) for line in res.data.decode().splitlines()]
+    assert len(results) == 3
+    assert results[0]["imageId"] == 1 and results[0]["segments"][0]["value"] == "52"
+    assert results[1]["error"]
+    assert results[2]["imageId"] == 2 and results[2]["segments"][0]["value"] == "15"
+
+
+def test_run_ocr_stream_gevent(app):
+    # A chunked request on the gevent server, answered line by line
+    import requests
+    from gevent.pywsgi import WSGIServer
+
+    server = WSGIServer(("127.0.0.1", 0), app, log=None)
+    server.start()
+    try:
+        messages = (
+            json.dumps({"monitorId": "b", "imageId": i, "segments": [{"name": "HR", "value": str(60 + i)}]}) + "\n"
+            for i in range(50)
+        )
+        res = requests.post(f"http://127.0.0.1:{server.server_port}/v1/run_ocr_stream", data=messages, timeout=30, stream=True)
+        results = [json.loads(line) for line in res.iter_lines() if line]
+        assert [r["imageId"] for r in results] == list(range(50))
+        assert [r["segments"][0]["value"] for r in results] == [str(60 + i) for i in range(50)]
+    finally:
+        server.stop()
+
+
+def test_delete_monitor_state(client):
+    client.post(url_for("cv.run_ocr"), json={"monitorId": "to-forget", "imageId": 1, "segments": [{"name": "HR", "value": "60"}]})
+    metrics = client.get("/metrics").data.decode()
+    assert "cvmonitor_monitor_states" in metrics and "cvmonitor_monitor_state_bytes" in metrics
+    assert client.delete(url_for("cv.delete_monitor_state", monitorId="to-forget")).status_code == 204
+    assert client.delete(url_for("cv.delete_monitor_state", monitorId="to-forget")).status_code == 404
+
+
+def test_run_ocr_batch(client):
+    items = [
+        {"monitorId": "ward-1", "imageId": 1, "segments": [{"name": "HR", "value": " 52"}]},
+        {"monitorId": "ward-2", "imageId": 1, "segments": [{"name": "RR", "value": "(15)"}]},
+        {"monitorId": "ward-1", "imageId": 2, "segments": [{"name": "HR", "value": "a53"}]},
+        {"monitorId": "ward-3", "segments": "bad"},
+        1,
+        "ward-4",
+    ]
+    res = client.post(url_for("cv.run_ocr_batch"), json=items)
+    assert res.status_code == 200
+    assert res.json["ward-1"][0]["value"] == "53"
+    assert res.json["ward-2"][0]["value"] == "15"
+    assert set(res.json) == {"ward-1", "ward-2", "ward-3", "#4", "#5"}
+    assert "error" in res.json["#4"]
+    assert client.post(url_for("cv.run_ocr_batch"), json={"monitorId": "x"}).status_code == 400
+
+
+def test_history(client, server, monkeypatch):
+    monkeypatch.setenv("CVMONITOR_HISTORY_SIZE", "32")
+    server.reload()
+    for i, value in enumerate(["70", "71", "71"]):
+        client.post(url_for("cv.run_ocr"), json={"monitorId": "with-history", "imageId": i, "segments": [{"name": "HR", "value": value}]})
+    res = client.get(url_for("cv.history", monitorId="with-history", sensor="HR", limit=2))
+    assert res.status_code == 200
+    assert res.json["sensors"]["HR"]["values"] == ["71", "71"]
+    assert res.json["sensors"]["HR"]["mode"] == "71" and res.json["sensors"]["HR"]["min"] == 70
+    assert client.get(url_for("cv.history", monitorId="no-history")).status_code == 404
+    assert client.get(url_for("cv.history", monitorId="with-history", limit=-1)).status_code == 400
+
+
+def test_run_ocr_out_of_order(client):
+    frame = {"monitorId": "late-frames", "imageId": 1, "timestamp": "2020-04-01T10:00:01", "segments": [{"name": "HR", "value": "60"}]}
+    assert client.post(url_for("cv.run_ocr"), json=frame).status_code == 200
+    frame.update(imageId=2, timestamp="2020-04-01T10:00:00")
+    assert client.post(url_for("cv.run_ocr"), json=frame).status_code == 409
+    assert "cvmonitor_ocr_out_of_order_total 1.0" in client.get("/metrics").data.decode()
+
+
+def test_align_output_options(client):
+    image = open(os.path.dirname(__file__) + "/data/sample.jpeg", "rb").read()
+    res = client.post(url_for("cv.align_image", format="png", gray="true", max_dim=200), data=image)
+    assert res.status_code == 200 and res.content_type == "image/png"
+    res_image = np.asarray(imageio.imread(res.data))
+    assert res_image.ndim == 2 and max(res_image.shape) == 200
+    res = client.post(url_for("cv.align_image"), data=image, headers={"accept": "image/webp,image/*;q=0.8"})
+    assert res.content_type == "image/webp" and res.headers["Vary"] == "Accept"
+    small = client.post(url_for("cv.align_image", quality=20), data=image)
+    assert small.content_type == "image/jpeg" and small.content_length < client.post(url_for("cv.align_image"), data=image).content_length
+    for bad in [dict(format="gif"), dict(quality=0), dict(max_dim="big"), dict(gray="maybe")]:
+        assert client.post(url_for("cv.align_image", **bad), data=image).status_code == 400
+
+
+def test_align_segments(client, server, monkeypatch):
+    image = base64.b64encode(open(os.path.dirname(__file__) + "/data/qrcode.png", "rb").read()).decode()
+    monkeypatch.setenv("CVMONITOR_ORIENT_BY_QR", "TRUE")
+    monkeypatch.setenv("CVMONITOR_QR_PREFIX", "http")
+    server.reload()
+    segments = [{"name": "HR", "left": 0, "top": 0, "right": 40, "bottom": 30}, {"name": "RR", "left": 50, "top": 10, "right": 70, "bottom": 20}]
+    res = client.post(url_for("cv.align_segments_tiles", gray="true"), json={"image": image, "segments": segments})
+    assert res.status_code == 200 and res.content_length == len(res.data)
+    parts = split_length_prefixed(res.data)
+    assert [s["name"] for s in json.loads(parts[0])] == ["HR", "RR"]
+    assert [np.asarray(imageio.imread(part)).shape for part in parts[1:]] == [(30, 40), (10, 20)]
+    assert client.post(url_for("cv.align_segments_tiles"), json={"image": image}).status_code == 400
+    res = client.post(url_for("cv.align_segments_tiles"), json={"image": image, "segments": [{"name": "HR", "left": -9, "top": -9, "right": -1, "bottom": -1}]})
+    assert res.status_code == 400
+    for bad in [[1], ["a"], [None]]:
+        assert client.post(url_for("cv.align_segments_tiles"), json={"image": image, "segments": bad}).status_code == 400
+    assert client.post(url_for("cv.align_segments_tiles"), json={"image": 1, "segments": segments}).status_code == 400
+    monkeypatch.setenv("CVMONITOR_ALIGN_MAX_SEGMENTS", "1")
+    server.reload()
+    assert client.post(url_for("cv.align_segments_tiles"), json={"image": image, "segments": segments}).status_code == 413
+    monkeypatch.setenv("CVMONITOR_ALIGN_MAX_SEGMENTS", "2")
+    monkeypatch.setenv("CVMONITOR_ALIGN_MAX_SEGMENT_PIXELS", "1000")
+    server.reload()
+    assert client.post(url_for("cv.align_segments_tiles"), json={"image": image, "segments": segments}).status_code == 400
@@ -1,4 +1,20 @@
+import datetime
+import struct
+import threading
+import time
+from collections import OrderedDict
+
 import cv2
+import imageio
+import numpy as np
+
+
+# The default jpeg quality, the one imageio (pillow) used to encode with
+JPEG_QUALITY = 75
+# The quality parameter of the formats that have one
+QUALITY_PARAMS = {'.jpg': cv2.IMWRITE_JPEG_QUALITY, '.webp': cv2.IMWRITE_WEBP_QUALITY}
+# Per thread scratch image for the RGB to BGR conversion before encoding, reused while the size doesn't change
+_encode_scratch = threading.local()
 
 
 def is_int(val):
@@ -9,6 +25,26 @@ def is_int(val):
     return True
 
 
+def parse_timestamp(value):
+    """
+    Seconds since the epoch of a client timestamp: a number of seconds or an ISO 8601 string (UTC if it has no timezone),
+    None if it is missing or can't be parsed
+    """
+    if value is None or value == '':
+        return None
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        pass
+    try:
+        t = datetime.datetime.fromisoformat(str(value).replace('Z', '+00:00'))
+    except ValueError:
+        return None
+    if t.tzinfo is None:
+        t = t.replace(tzinfo=datetime.timezone.utc)
+    return t.timestamp()
+
+
 def draw_segments(image, segments):
     for s in segments:
         location = [int(s['left']), int(s['top'])], [int(s['right']), int(s['bottom'])]
@@ -19,3 +55,163 @@ def draw_segments(image, segments):
             fontFace=cv2.FONT_HERSHEY_PLAIN, fontScale=1, color=color, thickness=1
         )
     return image
+
+
+def decode_gray(data):
+    """
+    Decode only the luminance of an encoded image, as decoded (without applying the exif orientation).
+    libjpeg outputs the Y channel of a jpeg as is, without upsampling the chroma or converting the colors.
+    :param data: the encoded image, any bytes like object
+    :return: the grayscale image, a 2d uint8 array
+    """
+    image = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_GRAYSCALE | cv2.IMREAD_IGNORE_ORIENTATION)
+    if image is not None:
+        return image
+    # a format opencv doesn't read
+    image = np.asarray(imageio.imread(bytes(data)))
+    if image.ndim == 3:
+        image = cv2.cvtColor(image[..., :3], cv2.COLOR_RGB2GRAY)
+    return image
+
+
+def encode_image(image, ext='.jpg', quality=JPEG_QUALITY):
+    """
+    Encode an RGB (or grayscale) image with opencv, the encoder writes straight into the array it returns,
+    without the BytesIO copies of imageio. Send it with memoryview() to avoid copying it to bytes.
+    :param ext: the format, e.g. '.jpg', '.png' or '.webp'
+    :param quality: the jpeg or webp quality (1-100)
+    :return: the encoded image, a uint8 array
+    """
+    if image.ndim == 3 and image.shape[2] == 3:
+        scratch = getattr(_encode_scratch, 'image', None)
+        if scratch is None or scratch.shape != image.shape or scratch.dtype != image.dtype:
+            scratch = _encode_scratch.image = np.empty_like(image)
+        image = cv2.cvtColor(image, cv2.COLOR_RGB2BGR, dst=scratch)
+    ok, encoded = cv2.imencode(ext, image, [QUALITY_PARAMS[ext], quality] if ext in QUALITY_PARAMS else [])
+    if not ok:
+        raise ValueError(f'Could not encode the image as {ext}')
+    return encoded.reshape(-1)
+
+
+def draw_segments_on(data, segments, quality=JPEG_QUALITY):
+    """
+    Decode an encoded image, draw the segments on it and encode it back as jpeg
+    :return: the jpeg, see encode_image
+    """
+    image = np.asarray(imageio.imread(data))
+    if segments:
+        image = draw_segments(image, segments)
+    return encode_image(image, quality=quality)
+
+
+def split_length_prefixed(data):
+    """
+    Split a body of frames, each prefixed by its length as a 4 bytes big endian unsigned int
+    """
+    frames = []
+    offset = 0
+    while offset < len(data):
+        if offset + 4 > len(data):
+            raise ValueError("Truncated frame length")
+        (length,) = struct.unpack_from(">I", data, offset)
+        offset += 4
+        if offset + length > len(data):
+            raise ValueError("Truncated frame")
+        frames.append(data[offset:offset + length])
+        offset += length
+    return frames
+
+
+def join_length_prefixed(parts):
+    """
+    The chunks of a body of parts, each prefixed by its length (see split_length_prefixed), the parts are not copied
+    """
+    chunks = []
+    for part in parts:
+        part = memoryview(part).cast('B')
+        chunks += [struct.pack(">I", part.nbytes), part]
+    return chunks
+
+
+class LRUCache:
+    """
+    A mapping of at most `maxsize` items, evicting the least recently used one.
+    Items expire `ttl` seconds after they were set (never if ttl is None).
+    `on_remove(key, value)` is called for every item that is evicted, expired, popped or replaced.
+    """
+
+    def __init__(self, maxsize, ttl=None, clock=time.monotonic, on_remove=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        self.on_remove = on_remove
+        self.items = OrderedDict()
+
+    def get(self, key, default=None):
+        item = self.items.get(key)
+        if item is None:
+            return default
+        value, expires = item
+        if expires is not None and expires <= self.clock():
+            self.remove(key)
+            return default
+        self.items.move_to_end(key)
+        return value
+
+    def peek(self, key, default=None):
+        """
+        Look up an item without making it the most recently used one (expired items are not returned)
+        """
+        item = self.items.get(key)
+        if item is None or item[1] is not None and item[1] <= self.clock():
+            return default
+        return item[0]
+
+    def set(self, key, value):
+        expires = self.clock() + self.ttl if self.ttl is not None else None
+        previous = self.items.get(key)
+        self.items[key] = (value, expires)
+        self.items.move_to_end(key)
+        if previous is not None and previous[0] is not value and self.on_remove is not None:
+            self.on_remove(key, previous[0])
+        self.trim()
+
+    def pop(self, key, default=None):
+        if key not in self.items:
+            return default
+        return self.remove(key)
+
+    def remove(self, key):
+        value, _ = self.items.pop(key)
+        if self.on_remove is not None:
+            self.on_remove(key, value)
+        return value
+
+    def resize(self, maxsize, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.trim()
+
+    def expire(self):
+        """
+        Remove the expired items, which are otherwise only removed when they are looked up or evicted
+        """
+        now = self.clock()
+        for key in [key for key, (_, expires) in self.items.items() if expires is not None and expires <= now]:
+            self.remove(key)
+
+    def keys(self):
+        return list(self.items.keys())
+
+    def values(self):
+        return [value for value, _ in self.items.values()]
+
+    def trim(self):
+        while len(self.items) > self.maxsize:
+            self.remove(next(iter(self.items)))
+
+    def __contains__(self, key):
+        return self.get(key, self) is not self
+
+    def __len__(self):
+        return len(self.items)